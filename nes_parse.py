@@ -1,8 +1,21 @@
 #!/usr/bin/python
+import time
+startup_time = time.time()
+
+import os
+import signal
+import sys
 from argparse import ArgumentParser
 
+from pynes import PyNESException
 from pynes.nesfile import NESFile
+from pynes.nesapu import WavSink, PygameMixerSink
+from pynes.nescdl import NESCodeDataLogger
+from pynes.nesdebug import NESDebugger
 from pynes.nesproc import NESProc
+from pynes.nesvideo import FrameDumper
+
+import_time = time.time()
 
 '''
 try:
@@ -28,15 +41,121 @@ except ImportError:
 
 if __name__=='__main__':
     parser = ArgumentParser(description="An NES emulator implemented in Python")
-    parser.add_argument("rom_file", help="Input NES ROM file")
+    parser.add_argument("rom_file", nargs='?', help="Input NES ROM file")
     parser.add_argument("-l", dest="log_level", default='warning',
             help="The logging level [debug, info, warning, error, critical]")
+    parser.add_argument("--video", dest="video", default='serial',
+            choices=['serial', 'threaded', 'none'],
+            help="Frame presentation: inline, on a presenter thread, or headless")
+    parser.add_argument("--dump-frames", dest="dump_frames", default=None,
+            help="Stream every frame as PPM/PGM images to a file, FIFO or '-' for stdout (runs headless)")
+    parser.add_argument("--dump-format", dest="dump_format", default='rgb',
+            choices=['rgb', 'indexed'],
+            help="Dumped frame format: RGB (PPM) or palette indices (PGM)")
+    parser.add_argument("--audio", dest="audio", action="store_true",
+            help="Play APU output through the pygame mixer (requires NumPy)")
+    parser.add_argument("--audio-wav", dest="audio_wav", default=None,
+            help="Write APU output to a WAV file (requires NumPy)")
+    parser.add_argument("-d", "--debug", dest="debug", action="store_true",
+            help="Start in the interactive debugger")
+    parser.add_argument("-x", "--debug-script", dest="debug_script", default=None,
+            help="Run debugger commands from a file (implies --debug)")
+    parser.add_argument("--cdl", dest="cdl", default=None,
+            help="Record a code/data log of PRG accesses and write it to this file at exit")
+    parser.add_argument("--catalog", dest="catalog", default=None,
+            help="Index every ROM below this directory and exit")
+    parser.add_argument("--catalog-index", dest="catalog_index", default=None,
+            help="Index file for --catalog (default: DIR/.pynes_index.json)")
+    parser.add_argument("--serve", dest="serve", default=None,
+            help="Run the control server on [HOST:]PORT or unix:PATH instead of a ROM")
+    parser.add_argument("--trace-check", dest="trace_check", default=None,
+            help="Compare every instruction against a reference log (nestest.log format) and exit")
+    parser.add_argument("--trace", dest="trace", default=None,
+            help="Write a CPU trace in the same format to this file and exit")
+    parser.add_argument("--trace-limit", dest="trace_limit", type=int, default=None,
+            help="Stop tracing after this many instructions")
+    parser.add_argument("--startup-profile", dest="startup_profile", action="store_true",
+            help="Report time spent importing modules and initialising the emulator")
     
     args = parser.parse_args()
     
+    # The catalog, control server and trace checker are imported only when
+    # asked for, so they don't add to the start up time of a normal run
+    if args.catalog:
+        from pynes.nescatalog import ROMCatalog
+        index_path = args.catalog_index or os.path.join(args.catalog, '.pynes_index.json')
+        catalog = ROMCatalog(index_path)
+        catalog.scan(args.catalog)
+        print "Indexed %d ROMs (%d parsed, %d cached) into %s" % \
+            (len(catalog.entries), catalog.parsed, catalog.cached, index_path)
+        sys.exit()
+    if args.serve:
+        from pynes.nesserver import NESControlServer
+        try:
+            server = NESControlServer(args.serve, args.log_level)
+        except PyNESException, e:
+            print e
+            sys.exit(1)
+        server.serve_forever()
+        sys.exit()
+    if not args.rom_file:
+        parser.error("a ROM file is required")
+    
+    if args.dump_frames == '-':
+        # stdout carries the frame stream, so console messages go to stderr
+        sys.stdout = sys.stderr
     nes_file = NESFile(args.rom_file)
-    nes_file.parse()
+    if not nes_file.parse():
+        sys.exit(1)
     #nes_file.read_memory(0xC000,4)
     #nes_file.dump_chrs()
-    proc = NESProc(nes_file, args.log_level)
-    proc.run()
+    video = args.video
+    if args.trace or args.trace_check or args.dump_frames:
+        # Tracing and frame dumps are meant to run headless (e.g. on CI)
+        video = 'none'
+    proc = NESProc(nes_file, args.log_level, video)
+    if args.dump_frames:
+        proc.frame_sinks.append(FrameDumper(args.dump_frames, proc.ppu.palette,
+            args.dump_format))
+    if args.audio_wav:
+        proc.apu.add_sink(WavSink(args.audio_wav, proc.apu.sample_rate))
+    if args.audio:
+        proc.apu.add_sink(PygameMixerSink(proc.apu.sample_rate))
+    if args.trace_check or args.trace:
+        from pynes.nestrace import NESTraceChecker
+        output = None
+        if args.trace:
+            output = open(args.trace, 'w')
+        checker = NESTraceChecker(proc, args.trace_check, output)
+        proc.load_vectors()
+        if args.trace_check:
+            ok = checker.check(limit=args.trace_limit)
+        else:
+            checker.record(args.trace_limit)
+            ok = True
+        if output:
+            output.close()
+        sys.exit(0 if ok else 1)
+    cdl = None
+    if args.cdl:
+        cdl = NESCodeDataLogger(proc, args.cdl)
+    debugger = None
+    if args.debug or args.debug_script:
+        debugger = NESDebugger(proc, args.debug_script)
+    if args.startup_profile:
+        init_time = time.time()
+        sys.stderr.write("Startup: imports %.1f ms, ROM load and init %.1f ms, total %.1f ms\n" % \
+            ((import_time - startup_time) * 1000, (init_time - import_time) * 1000,
+             (init_time - startup_time) * 1000))
+    # Batch runs are usually ended with SIGTERM (kill, timeout); exit through
+    # the normal cleanup so the CDL and the frame/audio sinks are written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(143))
+    try:
+        proc.run(debugger)
+    except PyNESException, e:
+        print e
+        sys.exit(1)
+    finally:
+        if cdl:
+            cdl.save()
+            cdl.print_coverage()
@@ -9,6 +9,17 @@ LEVELS = {'debug': logging.DEBUG,
              'error': logging.ERROR,
              'critical': logging.CRITICAL}
 
+# Loggers are process wide, so the console handler is only attached the first
+# time one is requested instead of once per emulator object
+def get_logger(name, log_level):
+    log = logging.getLogger(name)
+    if not log.handlers:
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        log.addHandler(ch)
+    log.setLevel(LEVELS[log_level])
+    return log
+
 class PyNESException(Exception):
     def __init__(self, string):
         self.err_msg = string
@@ -0,0 +1,567 @@
+import math
+import wave
+
+from pynes import *
+
+# NumPy is optional and, like the synthesis tables below, only loaded once an
+# audio sink is added
+numpy = None
+
+# Reference: http://wiki.nesdev.com/w/index.php/APU
+CPU_HZ = 1789773
+
+LENGTH_TABLE = [10, 254, 20, 2, 40, 4, 80, 6, 160, 8, 60, 10, 14, 12, 26, 14,
+                12, 16, 24, 18, 48, 20, 96, 22, 192, 24, 72, 26, 16, 28, 32, 30]
+
+DUTY_TABLE = [[0, 1, 0, 0, 0, 0, 0, 0], [0, 1, 1, 0, 0, 0, 0, 0],
+              [0, 1, 1, 1, 1, 0, 0, 0], [1, 0, 0, 1, 1, 1, 1, 1]]
+
+TRIANGLE_TABLE = range(15, -1, -1) + range(16)
+
+NOISE_PERIODS = [4, 8, 16, 32, 64, 96, 128, 160, 202, 254, 380, 508, 762, 1016, 2034, 4068]
+
+# Period of the LFSR output in long (feedback bit 1) and short (bit 6) mode
+NOISE_LENGTHS = [32767, 93]
+
+DMC_RATES = [428, 380, 340, 320, 286, 254, 226, 214, 190, 160, 142, 128, 106, 84, 72, 54]
+
+# Frame counter quarter-frame clock points (in CPU cycles) for the 4 and 5 step
+# sequences; half-frame clocks happen on the 2nd and last entries
+FRAME_SEQUENCES = {4: [7457, 14913, 22371, 29829], 5: [7457, 14913, 22371, 37281]}
+
+def noise_sequence(mode_bit):
+    # Output bit of the 15-bit LFSR for every shift, for one full period
+    lfsr = 1
+    out = []
+    while True:
+        out.append(0 if lfsr & 1 else 1)
+        feedback = (lfsr & 1) ^ ((lfsr >> mode_bit) & 1)
+        lfsr = (lfsr >> 1) | (feedback << 14)
+        if lfsr == 1:
+            return out
+
+# Sample synthesis tables; the noise LFSR period alone is a 32767 step loop
+DUTY_ARRAYS = TRIANGLE_ARRAY = NOISE_ARRAYS = None
+
+def build_tables():
+    global numpy, DUTY_ARRAYS, TRIANGLE_ARRAY, NOISE_ARRAYS
+    if NOISE_ARRAYS is not None:
+        return
+    try:
+        import numpy
+    except ImportError:
+        raise PyNESException("Audio output requires NumPy")
+    DUTY_ARRAYS = [numpy.array(d, dtype=float) for d in DUTY_TABLE]
+    TRIANGLE_ARRAY = numpy.array(TRIANGLE_TABLE, dtype=float)
+    NOISE_ARRAYS = [numpy.array(noise_sequence(1), dtype=float),
+                    numpy.array(noise_sequence(6), dtype=float)]
+
+class Envelope:
+    def __init__(self):
+        self.start = False
+        self.loop = False
+        self.constant = False
+        self.period = 0
+        self.divider = 0
+        self.decay = 0
+    
+    def write(self, value):
+        self.loop = bool(value & 0x20)
+        self.constant = bool(value & 0x10)
+        self.period = value & 0x0F
+    
+    def clock(self):
+        if self.start:
+            self.start = False
+            self.decay = 15
+            self.divider = self.period
+        elif self.divider == 0:
+            self.divider = self.period
+            if self.decay:
+                self.decay -= 1
+            elif self.loop:
+                self.decay = 15
+        else:
+            self.divider -= 1
+    
+    def volume(self):
+        if self.constant:
+            return self.period
+        return self.decay
+
+# Each channel renders a block of output levels for the sample offsets 't'
+# (CPU cycles from the start of a segment during which no register changes)
+# and then advances its sequencer position by the segment length.
+class PulseChannel:
+    def __init__(self, ones_complement):
+        self.ones_complement = ones_complement
+        self.envelope = Envelope()
+        self.enabled = False
+        self.duty = 0
+        self.halt = False
+        self.timer = 0
+        self.length = 0
+        self.sweep_enabled = False
+        self.sweep_period = 0
+        self.sweep_negate = False
+        self.sweep_shift = 0
+        self.sweep_divider = 0
+        self.sweep_reload = False
+        self.pos = 0.0
+    
+    def write(self, reg, value):
+        if reg == 0:
+            self.duty = value >> 6
+            self.halt = bool(value & 0x20)
+            self.envelope.write(value)
+        elif reg == 1:
+            self.sweep_enabled = bool(value & 0x80)
+            self.sweep_period = (value >> 4) & 0x07
+            self.sweep_negate = bool(value & 0x08)
+            self.sweep_shift = value & 0x07
+            self.sweep_reload = True
+        elif reg == 2:
+            self.timer = (self.timer & 0x700) | value
+        else:
+            self.timer = (self.timer & 0xFF) | ((value & 0x07) << 8)
+            if self.enabled:
+                self.length = LENGTH_TABLE[value >> 3]
+            self.envelope.start = True
+            self.pos = 0.0
+    
+    def sweep_target(self):
+        change = self.timer >> self.sweep_shift
+        if self.sweep_negate:
+            return self.timer - change - self.ones_complement
+        return self.timer + change
+    
+    def muted(self):
+        return self.length == 0 or self.timer < 8 or self.sweep_target() > 0x7FF
+    
+    def quarter_clock(self):
+        self.envelope.clock()
+    
+    def half_clock(self):
+        if self.length and not self.halt:
+            self.length -= 1
+        if self.sweep_divider == 0 and self.sweep_enabled and self.sweep_shift and not self.muted():
+            self.timer = self.sweep_target()
+        if self.sweep_divider == 0 or self.sweep_reload:
+            self.sweep_divider = self.sweep_period
+            self.sweep_reload = False
+        else:
+            self.sweep_divider -= 1
+    
+    def render(self, t, cycles):
+        period = (self.timer + 1) * 2.0
+        out = None
+        if t is not None:
+            if self.muted():
+                out = numpy.zeros(len(t))
+            else:
+                steps = (self.pos + t / period).astype(int) & 7
+                out = DUTY_ARRAYS[self.duty][steps] * self.envelope.volume()
+        self.pos = (self.pos + cycles / period) % 8
+        return out
+
+class TriangleChannel:
+    def __init__(self):
+        self.enabled = False
+        self.control = False
+        self.linear_reload_value = 0
+        self.linear_reload = False
+        self.linear = 0
+        self.timer = 0
+        self.length = 0
+        self.pos = 0.0
+    
+    def write(self, reg, value):
+        if reg == 0:
+            self.control = bool(value & 0x80)
+            self.linear_reload_value = value & 0x7F
+        elif reg == 2:
+            self.timer = (self.timer & 0x700) | value
+        elif reg == 3:
+            self.timer = (self.timer & 0xFF) | ((value & 0x07) << 8)
+            if self.enabled:
+                self.length = LENGTH_TABLE[value >> 3]
+            self.linear_reload = True
+    
+    def quarter_clock(self):
+        if self.linear_reload:
+            self.linear = self.linear_reload_value
+        elif self.linear:
+            self.linear -= 1
+        if not self.control:
+            self.linear_reload = False
+    
+    def half_clock(self):
+        if self.length and not self.control:
+            self.length -= 1
+    
+    def render(self, t, cycles):
+        # The sequencer only runs while both counters are non-zero; otherwise
+        # the output holds its current level. Ultrasonic periods are held too.
+        running = self.length and self.linear and self.timer >= 2
+        period = self.timer + 1.0
+        out = None
+        if t is not None:
+            if running:
+                steps = (self.pos + t / period).astype(int) & 31
+                out = TRIANGLE_ARRAY[steps]
+            else:
+                out = numpy.empty(len(t))
+                out.fill(TRIANGLE_TABLE[int(self.pos) & 31])
+        if running:
+            self.pos = (self.pos + cycles / period) % 32
+        return out
+
+class NoiseChannel:
+    def __init__(self):
+        self.envelope = Envelope()
+        self.enabled = False
+        self.halt = False
+        self.mode = 0
+        self.period = NOISE_PERIODS[0]
+        self.length = 0
+        self.pos = 0.0
+    
+    def write(self, reg, value):
+        if reg == 0:
+            self.halt = bool(value & 0x20)
+            self.envelope.write(value)
+        elif reg == 2:
+            self.mode = value >> 7
+            self.period = NOISE_PERIODS[value & 0x0F]
+        elif reg == 3:
+            if self.enabled:
+                self.length = LENGTH_TABLE[value >> 3]
+            self.envelope.start = True
+    
+    def quarter_clock(self):
+        self.envelope.clock()
+    
+    def half_clock(self):
+        if self.length and not self.halt:
+            self.length -= 1
+    
+    def render(self, t, cycles):
+        # The LFSR output is periodic, so one precomputed period per mode is
+        # indexed instead of shifting the register every clock. The phase
+        # advances even without a sink, when the tables aren't built.
+        out = None
+        if t is not None:
+            seq = NOISE_ARRAYS[self.mode]
+            if self.length == 0:
+                out = numpy.zeros(len(t))
+            else:
+                steps = (self.pos + t / float(self.period)).astype(int) % len(seq)
+                out = seq[steps] * self.envelope.volume()
+        self.pos = (self.pos + cycles / float(self.period)) % NOISE_LENGTHS[self.mode]
+        return out
+
+class DMCChannel:
+    def __init__(self, nes_core):
+        self.nes_core = nes_core
+        self.loop = False
+        self.rate = DMC_RATES[0]
+        self.level = 0
+        self.sample_addr = 0xC000
+        self.sample_length = 1
+        self.addr = 0xC000
+        self.bytes_remaining = 0
+        self.shift = 0
+        self.bits_remaining = 0
+        self.silence = True
+        self.pos = 0.0
+    
+    def write(self, reg, value):
+        if reg == 0:
+            self.loop = bool(value & 0x40)
+            self.rate = DMC_RATES[value & 0x0F]
+        elif reg == 1:
+            self.level = value & 0x7F
+        elif reg == 2:
+            self.sample_addr = 0xC000 + value * 64
+        else:
+            self.sample_length = value * 16 + 1
+    
+    def restart(self):
+        self.addr = self.sample_addr
+        self.bytes_remaining = self.sample_length
+    
+    def next_bit(self):
+        if self.bits_remaining == 0:
+            self.bits_remaining = 8
+            if self.bytes_remaining:
+                self.shift = ord(self.nes_core.read_memory(self.addr, 1))
+                self.addr = 0x8000 if self.addr == 0xFFFF else self.addr + 1
+                self.bytes_remaining -= 1
+                if self.bytes_remaining == 0 and self.loop:
+                    self.restart()
+                self.silence = False
+            else:
+                self.silence = True
+        bit = self.shift & 1
+        self.shift >>= 1
+        self.bits_remaining -= 1
+        if self.silence:
+            return
+        if bit:
+            if self.level <= 125:
+                self.level += 2
+        elif self.level >= 2:
+            self.level -= 2
+    
+    def render(self, t, cycles):
+        # Clamping makes the level sequential, so the levels at each bit
+        # boundary are stepped in Python (a few hundred per frame at most)
+        # and the samples then index into them
+        start = self.pos
+        end = start + cycles / float(self.rate)
+        count = int(end)
+        levels = [self.level]
+        for i in range(count):
+            self.next_bit()
+            levels.append(self.level)
+        self.pos = end - count
+        if t is None:
+            return None
+        steps = (start + t / float(self.rate)).astype(int)
+        return numpy.array(levels, dtype=float)[numpy.minimum(steps, count)]
+
+class NES_APU:
+    def __init__(self, nes_core, log_level='warning', sample_rate=48000):
+        self.nes_core = nes_core
+        self.sample_rate = sample_rate
+        self.cycles_per_sample = float(CPU_HZ) / sample_rate
+        self.sinks = []
+        
+        self.pulse1 = PulseChannel(1)
+        self.pulse2 = PulseChannel(0)
+        self.triangle = TriangleChannel()
+        self.noise = NoiseChannel()
+        self.dmc = DMCChannel(nes_core)
+        self.channels = [self.pulse1, self.pulse2, self.triangle, self.noise, self.dmc]
+        self.registers = {}
+        for i in range(4):
+            self.registers[0x4000+i] = (self.pulse1, i)
+            self.registers[0x4004+i] = (self.pulse2, i)
+            self.registers[0x4008+i] = (self.triangle, i)
+            self.registers[0x400C+i] = (self.noise, i)
+            self.registers[0x4010+i] = (self.dmc, i)
+        
+        self.frame_mode = 4
+        self.frame_step = 0
+        self.frame_cycle = 0
+        
+        # Register writes of the current frame: (cpu cycle, address, value)
+        self.writes = []
+        self.time = 0
+        self.next_sample = 0.0
+        self.filled = 0
+        self.buffers = None
+        self.dc = 0.0
+        
+        self.log = get_logger("6502-apu", log_level)
+        self.logEnabled = True
+    
+    def add_sink(self, sink):
+        build_tables()
+        if self.buffers is None:
+            size = int(self.sample_rate / 30) + 1
+            self.buffers = [numpy.zeros(size) for c in self.channels]
+        self.sinks.append(sink)
+    
+    # Channel registers only take effect when the APU catches up to the cycle
+    # they were written at, so writes are just timestamped and queued
+    def register_handler(self, addr):
+        def do_apu_register_access(is_write, val):
+            if is_write:
+                self.writes.append((self.nes_core.cycle_count, addr, ord(val[0])))
+        return do_apu_register_access
+    
+    def do_apu_status_access(self, is_write, val):
+        if is_write:
+            self.writes.append((self.nes_core.cycle_count, 0x4015, ord(val[0])))
+        else:
+            # Reads need the state at this point of the frame
+            self.catch_up(self.nes_core.cycle_count)
+            status = 0
+            for i, channel in enumerate(self.channels[:4]):
+                if channel.length:
+                    status |= 1 << i
+            if self.dmc.bytes_remaining:
+                status |= 0x10
+            self.nes_core.memory[0x4015] = status
+    
+    def do_apu_frame_counter_access(self, is_write, val):
+        # Reads of $4017 belong to joystick 2
+        if is_write:
+            self.writes.append((self.nes_core.cycle_count, 0x4017, ord(val[0])))
+    
+    def apply_write(self, addr, value):
+        if self.logEnabled: self.log.debug("APU: writing 0x%02x to $%04x" % (value, addr))
+        if addr == 0x4015:
+            for i, channel in enumerate(self.channels[:4]):
+                channel.enabled = bool(value & (1 << i))
+                if not channel.enabled:
+                    channel.length = 0
+            if not value & 0x10:
+                self.dmc.bytes_remaining = 0
+            elif self.dmc.bytes_remaining == 0:
+                self.dmc.restart()
+        elif addr == 0x4017:
+            self.frame_mode = 5 if value & 0x80 else 4
+            self.frame_step = 0
+            self.frame_cycle = 0
+            if self.frame_mode == 5:
+                self.clock_frame(True)
+        else:
+            channel, reg = self.registers[addr]
+            channel.write(reg, value)
+    
+    def clock_frame(self, half):
+        for channel in self.channels[:4]:
+            channel.quarter_clock()
+            if half:
+                channel.half_clock()
+    
+    def render(self, cycles):
+        t = None
+        if self.buffers is not None:
+            end = self.time + cycles
+            first = last = self.filled
+            if end > self.next_sample:
+                count = int(math.ceil((end - self.next_sample) / self.cycles_per_sample))
+                last = min(first + count, len(self.buffers[0]))
+            t = self.next_sample + numpy.arange(last - first) * self.cycles_per_sample - self.time
+            self.next_sample += (last - first) * self.cycles_per_sample
+            self.filled = last
+        for i, channel in enumerate(self.channels):
+            out = channel.render(t, cycles)
+            if t is not None:
+                self.buffers[i][first:last] = out
+        self.time += cycles
+        self.frame_cycle += cycles
+    
+    # Run every channel up to 'now' (CPU cycles into the frame), one block per
+    # span between register writes and frame counter clocks
+    def catch_up(self, now):
+        writes = self.writes
+        idx = 0
+        while self.time < now or (idx < len(writes) and writes[idx][0] <= now):
+            clock_at = self.time + FRAME_SEQUENCES[self.frame_mode][self.frame_step] - self.frame_cycle
+            target = min(now, clock_at)
+            if idx < len(writes):
+                target = min(target, max(writes[idx][0], self.time))
+            if target > self.time:
+                self.render(target - self.time)
+            if idx < len(writes) and writes[idx][0] <= self.time:
+                self.apply_write(writes[idx][1], writes[idx][2])
+                idx += 1
+            elif self.time >= clock_at:
+                sequence = FRAME_SEQUENCES[self.frame_mode]
+                self.clock_frame(self.frame_step == 1 or self.frame_step == len(sequence) - 1)
+                self.frame_step += 1
+                if self.frame_step == len(sequence):
+                    self.frame_step = 0
+                    self.frame_cycle -= sequence[-1] + 1
+        del writes[:idx]
+    
+    def mix(self, count):
+        (p1, p2, tri, noise, dmc) = [b[:count] for b in self.buffers]
+        # Non-linear mixer approximation from the nesdev wiki
+        pulse = p1 + p2
+        pulse_out = numpy.where(pulse > 0, 95.88 / (8128.0 / numpy.maximum(pulse, 1) + 100), 0)
+        tnd = tri / 8227.0 + noise / 12241.0 + dmc / 22638.0
+        tnd_out = numpy.where(tnd > 0, 159.79 / (1.0 / numpy.maximum(tnd, 1e-9) + 100), 0)
+        out = pulse_out + tnd_out
+        if count:
+            self.dc += (out.mean() - self.dc) * 0.1
+        out -= self.dc
+        return (numpy.clip(out, -1.0, 1.0) * 32000).astype(numpy.int16)
+    
+    # Called by the core once per frame with the frame length in CPU cycles
+    def end_frame(self, cycles):
+        self.catch_up(cycles)
+        if self.buffers is not None:
+            samples = self.mix(self.filled)
+            for sink in self.sinks:
+                sink.write_samples(samples)
+            self.filled = 0
+            self.next_sample -= cycles
+        for i in range(len(self.writes)):
+            (cycle, addr, value) = self.writes[i]
+            self.writes[i] = (max(cycle - cycles, 0), addr, value)
+        self.time = 0
+    
+    def save_state(self):
+        channels = []
+        for channel in self.channels:
+            state = dict(channel.__dict__)
+            state.pop('nes_core', None)
+            if 'envelope' in state:
+                state['envelope'] = dict(channel.envelope.__dict__)
+            channels.append(state)
+        return {'channels': channels,
+                'frame': (self.frame_mode, self.frame_step, self.frame_cycle),
+                'writes': list(self.writes),
+                'time': self.time}
+    
+    def load_state(self, state):
+        for channel, channel_state in zip(self.channels, state['channels']):
+            channel_state = dict(channel_state)
+            if 'envelope' in channel_state:
+                channel.envelope.__dict__.update(channel_state.pop('envelope'))
+            channel.__dict__.update(channel_state)
+        (self.frame_mode, self.frame_step, self.frame_cycle) = state['frame']
+        self.writes = list(state['writes'])
+        self.time = state['time']
+        self.filled = 0
+        self.next_sample = 0.0
+    
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+class WavSink:
+    def __init__(self, path, sample_rate):
+        self.wav = wave.open(path, 'wb')
+        self.wav.setnchannels(1)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(sample_rate)
+    
+    def write_samples(self, samples):
+        self.wav.writeframes(samples.tostring())
+    
+    def close(self):
+        self.wav.close()
+
+class PygameMixerSink:
+    def __init__(self, sample_rate):
+        import pygame
+        self.pygame = pygame
+        pygame.mixer.pre_init(sample_rate, -16, 1, 1024)
+        pygame.mixer.init()
+        # pygame.init() (serial video) may already have started the mixer at
+        # its default rate, which pre_init doesn't change
+        if pygame.mixer.get_init()[0] != sample_rate:
+            pygame.mixer.quit()
+            pygame.mixer.init(sample_rate, -16, 1, 1024)
+        self.channels = pygame.mixer.get_init()[2]
+        self.channel = pygame.mixer.Channel(0)
+    
+    def write_samples(self, samples):
+        if self.channels > 1:
+            samples = numpy.repeat(samples.reshape(-1, 1), self.channels, axis=1)
+        sound = self.pygame.sndarray.make_sound(numpy.ascontiguousarray(samples))
+        # One block plays while the next is queued; if both slots are taken the
+        # core is ahead of real time and the block is dropped
+        if not self.channel.get_busy():
+            self.channel.play(sound)
+        elif self.channel.get_queue() is None:
+            self.channel.queue(sound)
+    
+    def close(self):
+        self.pygame.mixer.quit()
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import zlib
+
+from pynes import *
+from nesfile import NESHeader
+
+INDEX_VERSION = 2
+
+class ROMCatalog:
+    # Persistent index of ROM header metadata and PRG/CHR hashes, keyed by
+    # absolute path. Entries are reused as long as the file's size and mtime
+    # are unchanged, so only new or modified ROMs are read and hashed.
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.entries = {}
+        self.parsed = 0
+        self.cached = 0
+        if os.path.exists(index_path):
+            try:
+                index = json.load(open(index_path))
+                if index.get('version') == INDEX_VERSION:
+                    # Paths are byte strings (os.walk on a str root) in no
+                    # particular encoding, so they are written as latin-1,
+                    # which maps every byte to one character and back
+                    self.entries = dict((path.encode('latin-1'), entry) \
+                        for path, entry in index['roms'].items())
+            except ValueError:
+                # A corrupt index is simply rebuilt
+                pass
+    
+    def scan(self, root, extensions=('.nes',)):
+        root = os.path.abspath(root)
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                if not name.lower().endswith(extensions):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                seen.add(path)
+                entry = self.entries.get(path)
+                if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+                    self.cached += 1
+                    continue
+                self.entries[path] = self.index_rom(path, st)
+                self.parsed += 1
+        
+        # Forget ROMs that disappeared from this tree
+        prefix = os.path.join(root, '')
+        for path in self.entries.keys():
+            if path.startswith(prefix) and path not in seen:
+                del self.entries[path]
+        self.save()
+    
+    def index_rom(self, path, st):
+        entry = {'size': st.st_size, 'mtime': st.st_mtime}
+        try:
+            rom = open(path, 'rb')
+            try:
+                data = mmap.mmap(rom.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                rom.close()
+        except (EnvironmentError, ValueError), e:
+            # Empty files cannot be mapped
+            entry['error'] = str(e)
+            return entry
+        
+        try:
+            header = NESHeader(data[:16])
+            entry.update(header.to_dict())
+            prg_start = 16
+            if header.trainer:
+                prg_start += 512
+            chr_start = prg_start + header.prg_size
+            if chr_start + header.chr_size > len(data):
+                raise PyNESException("File is shorter than its header claims")
+            # buffer() slices the mapping without copying it into a string
+            prg = buffer(data, prg_start, header.prg_size)
+            chr = buffer(data, chr_start, header.chr_size)
+            rom_sha1 = hashlib.sha1(prg)
+            rom_sha1.update(chr)
+            entry['prg_sha1'] = hashlib.sha1(prg).hexdigest()
+            entry['chr_sha1'] = hashlib.sha1(chr).hexdigest()
+            entry['rom_sha1'] = rom_sha1.hexdigest()
+            entry['prg_crc32'] = "%08x" % (zlib.crc32(prg) & 0xFFFFFFFF)
+            entry['chr_crc32'] = "%08x" % (zlib.crc32(chr) & 0xFFFFFFFF)
+            entry['rom_crc32'] = "%08x" % (zlib.crc32(chr, zlib.crc32(prg)) & 0xFFFFFFFF)
+        except PyNESException, e:
+            entry['error'] = str(e)
+        finally:
+            data.close()
+        return entry
+    
+    def save(self):
+        # Write to a temporary file first so a killed job never leaves a
+        # truncated index behind. Each job gets its own temporary file, so
+        # jobs sharing an index don't race on it.
+        index_dir = os.path.dirname(os.path.abspath(self.index_path))
+        (fd, tmp_path) = tempfile.mkstemp(prefix='.pynes_index', dir=index_dir)
+        try:
+            out = os.fdopen(fd, 'w')
+            json.dump({'version': INDEX_VERSION, 'roms': self.entries}, out,
+                      encoding='latin-1')
+            out.close()
+            # mkstemp creates the file private to this user
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, self.index_path)
+        except:
+            os.unlink(tmp_path)
+            raise
+    
+    # Paths of all valid ROMs whose metadata matches every given field,
+    # e.g. find(mapper=0, region='NTSC') or find(rom_sha1='...')
+    def find(self, **fields):
+        matches = []
+        for path, entry in sorted(self.entries.items()):
+            if 'error' in entry:
+                continue
+            for name, value in fields.items():
+                if entry.get(name) != value:
+                    break
+            else:
+                matches.append(path)
+        return matches
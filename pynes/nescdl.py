@@ -0,0 +1,93 @@
+import os
+
+from pynes import *
+
+# Code/Data Log flags, in the FCEUX .cdl layout for PRG bytes:
+# bit 0 = code, bit 1 = data, bits 2-3 = 8K CPU window the byte was seen in
+CDL_CODE = 0x01
+CDL_DATA = 0x02
+# Internal only: set on opcode bytes (as opposed to operands), dropped on save
+CDL_OPCODE = 0x80
+
+SAVE_MASK = ''.join([chr(i & 0x7F) for i in range(256)])
+
+class NESCodeDataLogger:
+    def __init__(self, nes_core, filename):
+        self.nes_core = nes_core
+        self.filename = filename
+        nes_file = nes_core.nes_file
+        self.prg_count = max(nes_file.prg_count, 1)
+        self.prg = [bytearray(0x4000) for i in range(self.prg_count)]
+        self.chr = bytearray(0x2000 * nes_file.chr_count)
+        # Banks mapped at $8000 and $C000, the same layout NESProc loads
+        if self.prg_count > 1:
+            self.windows = [self.prg[0], self.prg[1]]
+        else:
+            self.windows = [self.prg[0], self.prg[0]]
+        if os.path.exists(filename):
+            self.load(filename)
+        
+        core_fetch = nes_core.fetch_instruction
+        core_read = nes_core.read_memory
+        windows = self.windows
+        inst_set = nes_core.INST_SET
+        
+        def fetch_instruction():
+            data = core_fetch()
+            pc = nes_core.PC
+            if pc >= 0x8000:
+                inst = inst_set.get(data[0])
+                windows[(pc >> 14) & 1][pc & 0x3FFF] |= CDL_OPCODE | CDL_CODE | ((pc >> 11) & 0xC)
+                if inst:
+                    for addr in range(pc + 1, min(pc + inst[1], 0x10000)):
+                        windows[(addr >> 14) & 1][addr & 0x3FFF] |= CDL_CODE | ((addr >> 11) & 0xC)
+            return data
+        
+        def read_memory(addr, length):
+            if addr >= 0x8000:
+                for a in range(addr, min(addr + length, 0x10000)):
+                    windows[(a >> 14) & 1][a & 0x3FFF] |= CDL_DATA | ((a >> 11) & 0xC)
+            return core_read(addr, length)
+        
+        nes_core.fetch_instruction = fetch_instruction
+        nes_core.read_memory = read_memory
+    
+    # Merge an existing log so coverage accumulates across runs
+    def load(self, filename):
+        data = bytearray(open(filename, 'rb').read())
+        if len(data) != self.prg_count * 0x4000 + len(self.chr):
+            raise PyNESException("CDL file %s does not match the ROM size" % filename)
+        for i, bank in enumerate(self.prg):
+            for offset, flags in enumerate(data[i*0x4000:(i+1)*0x4000]):
+                if flags:
+                    bank[offset] |= flags
+        self.chr[:] = data[self.prg_count*0x4000:]
+    
+    def save(self, filename=None):
+        out = open(filename or self.filename, 'wb')
+        for bank in self.prg:
+            out.write(str(bank).translate(SAVE_MASK))
+        out.write(str(self.chr))
+        out.close()
+    
+    def coverage(self):
+        # (bank, opcode bytes, code bytes, data bytes, bytes not seen) per PRG bank
+        stats = []
+        for i, bank in enumerate(self.prg):
+            data = str(bank)
+            unseen = data.count('\x00')
+            opcodes = code = data_bytes = 0
+            for flags in bank:
+                if flags & CDL_OPCODE:
+                    opcodes += 1
+                if flags & CDL_CODE:
+                    code += 1
+                if flags & CDL_DATA:
+                    data_bytes += 1
+            stats.append((i, opcodes, code, data_bytes, unseen))
+        return stats
+    
+    def print_coverage(self):
+        for (bank, opcodes, code, data, unseen) in self.coverage():
+            print "PRG %d: %d code bytes (%d opcodes), %d data bytes, %.1f%% covered" % \
+                (bank, code, opcodes, data, 100.0 * (0x4000 - unseen) / 0x4000)
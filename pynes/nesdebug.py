@@ -0,0 +1,238 @@
+import cmd
+import struct
+
+from pynes import *
+from nesops import MODES
+
+def parse_number(text):
+    # Addresses and values are hex, with or without a $ or 0x prefix
+    text = text.strip().lower()
+    if text.startswith('$'):
+        text = text[1:]
+    elif text.startswith('0x'):
+        text = text[2:]
+    try:
+        return int(text, 16)
+    except ValueError:
+        raise PyNESException("Invalid number: %s" % text)
+
+def parse_address(text):
+    addr = parse_number(text)
+    if addr < 0 or addr > 0xFFFF:
+        raise PyNESException("Address out of range: %s" % text.strip())
+    return addr
+
+# Returns (hex bytes, instruction text, length) for the instruction at addr
+def disassemble(nes_core, addr):
+    data = nes_core.peek_memory(addr, 3)
+    if len(data) < 3:
+        data += '\x00' * (3 - len(data))
+    inst = nes_core.INST_SET.get(data[0])
+    if inst is None:
+        return ("%02x" % ord(data[0]), ".db $%02x" % ord(data[0]), 1)
+    (length, mnemonic, mode) = (inst[1], inst[3], inst[4])
+    raw = ' '.join(["%02x" % ord(c) for c in data[:length]])
+    syntax = MODES[mode][1]
+    if mode == 'rel':
+        operand = syntax % ((addr + length + struct.unpack('b', data[1])[0]) & 0xFFFF)
+    elif length == 2:
+        operand = syntax % ord(data[1])
+    elif length == 3:
+        operand = syntax % struct.unpack('H', data[1:3])[0]
+    else:
+        operand = syntax
+    if operand:
+        operand = ' ' + operand
+    return (raw, mnemonic + operand, length)
+
+class NESDebugger(cmd.Cmd):
+    # Breakpoints and watchpoints are 64K bitmaps indexed by address. They are
+    # only consulted by this debugger's own loop and by the memory accessors
+    # it installs on the core, so a core run without a debugger never sees them.
+    prompt = '(pynes) '
+    
+    def __init__(self, nes_core, script=None):
+        cmd.Cmd.__init__(self)
+        self.nes_core = nes_core
+        self.script = script
+        self.breakpoints = bytearray(0x10000)
+        self.read_watch = bytearray(0x10000)
+        self.write_watch = bytearray(0x10000)
+        self.watch_hit = None
+        self.temp_break = None
+        
+        core_read = nes_core.read_memory
+        core_write = nes_core.write_memory
+        read_watch = self.read_watch
+        write_watch = self.write_watch
+        
+        def read_memory(addr, length):
+            if read_watch[addr & 0xFFFF]:
+                self.watch_hit = ('read', addr)
+            return core_read(addr, length)
+        
+        def write_memory(addr, val):
+            if write_watch[addr & 0xFFFF]:
+                self.watch_hit = ('write', addr)
+            core_write(addr, val)
+        
+        nes_core.read_memory = read_memory
+        nes_core.write_memory = write_memory
+    
+    def run(self):
+        if self.script:
+            for line in open(self.script):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                print "%s%s" % (self.prompt, line)
+                if self.onecmd(line):
+                    return
+        self.print_location()
+        self.cmdloop()
+    
+    def run_until_break(self):
+        nes_core = self.nes_core
+        breakpoints = self.breakpoints
+        step = nes_core.step
+        self.watch_hit = None
+        try:
+            # Always execute one instruction so we can leave a breakpoint
+            step()
+            while not breakpoints[nes_core.PC] and self.watch_hit is None:
+                step()
+        except KeyboardInterrupt:
+            print "Interrupted"
+        finally:
+            if self.temp_break is not None:
+                self.breakpoints[self.temp_break] &= ~2
+                self.temp_break = None
+        if self.watch_hit:
+            print "Watchpoint: %s $%04x" % self.watch_hit
+        elif breakpoints[nes_core.PC]:
+            print "Breakpoint at $%04x" % nes_core.PC
+        self.print_location()
+    
+    def print_location(self):
+        print self.disassemble(self.nes_core.PC)[0]
+    
+    def disassemble(self, addr):
+        (raw, text, length) = disassemble(self.nes_core, addr)
+        return ("$%04x: %-8s  %s" % (addr, raw, text), length)
+    
+    def parse_range(self, arg, default_length):
+        args = arg.split()
+        if not args:
+            return (self.nes_core.PC, default_length)
+        start = parse_address(args[0])
+        if len(args) > 1:
+            return (start, parse_number(args[1]))
+        return (start, default_length)
+    
+    def onecmd(self, line):
+        try:
+            return cmd.Cmd.onecmd(self, line)
+        except (PyNESException, ValueError), e:
+            print e
+    
+    def emptyline(self):
+        pass
+    
+    def do_break(self, arg):
+        """break ADDR: stop when PC reaches ADDR (no argument lists breakpoints)"""
+        if not arg:
+            for addr in range(0x10000):
+                if self.breakpoints[addr] & 1:
+                    print "$%04x" % addr
+            return
+        self.breakpoints[parse_address(arg)] |= 1
+    do_b = do_break
+    
+    def do_delete(self, arg):
+        """delete ADDR: remove the breakpoint at ADDR"""
+        self.breakpoints[parse_address(arg)] &= ~1
+    
+    def set_watch(self, arg, value):
+        args = arg.split()
+        if not args:
+            raise PyNESException("Usage: watch [r|w|rw] ADDR [LEN]")
+        kind = 'rw'
+        if args[0] in ('r', 'w', 'rw'):
+            kind = args.pop(0)
+        (start, length) = self.parse_range(' '.join(args), 1)
+        for addr in range(start, min(start + length, 0x10000)):
+            if 'r' in kind:
+                self.read_watch[addr] = value
+            if 'w' in kind:
+                self.write_watch[addr] = value
+    
+    def do_watch(self, arg):
+        """watch [r|w|rw] ADDR [LEN]: stop on memory reads and/or writes"""
+        self.set_watch(arg, 1)
+    
+    def do_unwatch(self, arg):
+        """unwatch [r|w|rw] ADDR [LEN]: remove watchpoints"""
+        self.set_watch(arg, 0)
+    
+    def do_continue(self, arg):
+        """continue: run until a breakpoint or watchpoint is hit"""
+        self.run_until_break()
+    do_c = do_continue
+    
+    def do_step(self, arg):
+        """step [N]: execute N instructions (default 1)"""
+        count = 1
+        if arg:
+            count = int(arg)
+        self.watch_hit = None
+        for i in range(count):
+            self.nes_core.step()
+            if self.watch_hit:
+                print "Watchpoint: %s $%04x" % self.watch_hit
+                break
+        self.print_location()
+    do_s = do_step
+    
+    def do_next(self, arg):
+        """next: step over a JSR, otherwise step one instruction"""
+        nes_core = self.nes_core
+        if nes_core.peek_memory(nes_core.PC, 1) == '\x20':
+            # Temporary breakpoints use bit 1 so they don't clobber user ones
+            self.temp_break = (nes_core.PC + 3) & 0xFFFF
+            self.breakpoints[self.temp_break] |= 2
+            self.run_until_break()
+        else:
+            self.do_step('')
+    do_n = do_next
+    
+    def do_regs(self, arg):
+        """regs: dump the CPU registers and flags"""
+        nes_core = self.nes_core
+        print "A: $%02x, X: $%02x, Y: $%02x, S: $%04x, PC: $%04x, Cycles: %d" % \
+            (nes_core.A, nes_core.X, nes_core.Y, 0x0100 + nes_core.S, nes_core.PC, nes_core.cycle_count)
+        print "  [Flags] N: %d, V: %d, B: %d, D: %d, I: %d, Z: %d, C: %d" % \
+            tuple([bool(nes_core.P[f]) for f in 'NVBDIZC'])
+    do_r = do_regs
+    
+    def do_mem(self, arg):
+        """mem [ADDR] [LEN]: hex dump memory (default 64 bytes at PC)"""
+        (start, length) = self.parse_range(arg, 64)
+        for addr in range(start, min(start + length, 0x10000), 16):
+            row = bytearray(self.nes_core.peek_memory(addr, min(16, start + length - addr)))
+            print "$%04x: %s" % (addr, ' '.join(["%02x" % b for b in row]))
+    do_x = do_mem
+    
+    def do_dis(self, arg):
+        """dis [ADDR] [N]: disassemble N instructions (default 10 at PC)"""
+        (addr, count) = self.parse_range(arg, 10)
+        for i in range(count):
+            (text, length) = self.disassemble(addr)
+            print text
+            addr = (addr + length) & 0xFFFF
+    do_d = do_dis
+    
+    def do_quit(self, arg):
+        """quit: stop emulation"""
+        return True
+    do_q = do_quit
+    do_EOF = do_quit
@@ -1,46 +1,136 @@
-import struct
+import mmap
 
-class NESFile:
-    prgs = []
-    chrs = []
+from pynes import *
+
+MIRRORING = ['horizontal', 'vertical']
+REGIONS = ['NTSC', 'PAL', 'multi', 'Dendy']
+
+# Reference: http://wiki.nesdev.com/w/index.php/INES
+#            http://wiki.nesdev.com/w/index.php/NES_2.0
+class NESHeader:
+    def __init__(self, data):
+        if len(data) < 16 or data[:4] != "NES\x1a":
+            raise PyNESException("Not an iNES file")
+        b = [ord(c) for c in data[:16]]
+        self.nes2 = (b[7] & 0x0C) == 0x08
+        self.format = 'NES 2.0' if self.nes2 else 'iNES'
+        self.battery = bool(b[6] & 0x02)
+        self.trainer = bool(b[6] & 0x04)
+        if b[6] & 0x08:
+            self.mirroring = 'four-screen'
+        else:
+            self.mirroring = MIRRORING[b[6] & 0x01]
+        
+        if self.nes2:
+            self.mapper = (b[6] >> 4) | (b[7] & 0xF0) | ((b[8] & 0x0F) << 8)
+            self.submapper = b[8] >> 4
+            self.prg_size = self.rom_size(b[4], b[9] & 0x0F, 0x4000)
+            self.chr_size = self.rom_size(b[5], b[9] >> 4, 0x2000)
+            self.prg_ram_size = self.ram_size(b[10] & 0x0F)
+            self.prg_nvram_size = self.ram_size(b[10] >> 4)
+            self.chr_ram_size = self.ram_size(b[11] & 0x0F)
+            self.region = REGIONS[b[12] & 0x03]
+        else:
+            # Old dumping tools left garbage ("DiskDude!") in bytes 7-15, which
+            # makes the upper mapper nibble unreliable
+            if b[12] or b[13] or b[14] or b[15]:
+                self.mapper = b[6] >> 4
+            else:
+                self.mapper = (b[6] >> 4) | (b[7] & 0xF0)
+            self.submapper = 0
+            self.prg_size = b[4] * 0x4000
+            self.chr_size = b[5] * 0x2000
+            self.prg_ram_size = max(b[8], 1) * 0x2000
+            self.prg_nvram_size = 0
+            self.chr_ram_size = 0 if b[5] else 0x2000
+            self.region = REGIONS[b[9] & 0x01]
+        
+        # Raw flag bytes, as previously exposed by NESFile
+        self.mapping1 = b[6]
+        self.mapping2 = b[7]
+    
+    def rom_size(self, lsb, msb, unit):
+        if msb == 0x0F:
+            # Exponent-multiplier notation: 2^E * (MM*2+1) bytes
+            return (1 << (lsb >> 2)) * ((lsb & 0x03) * 2 + 1)
+        return ((msb << 8) | lsb) * unit
     
+    def ram_size(self, shift):
+        if shift:
+            return 64 << shift
+        return 0
+    
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in \
+            ['format', 'mapper', 'submapper', 'mirroring', 'battery', 'trainer',
+             'prg_size', 'chr_size', 'prg_ram_size', 'prg_nvram_size',
+             'chr_ram_size', 'region'])
+
+class NESFile:
     def __init__(self, filename=None):
         self.filename = filename
         try:
             self.rom = open(self.filename, 'rb')
         except:
             print "Unable to open ROM file: %s" % self.filename
-            return False
+            self.rom = None
     
+    # The ROM is mapped once and PRG/CHR banks are read-only buffer() slices
+    # of the mapping, so banks are shared through the page cache and never
+    # copied into strings
     def parse(self):
-        header = self.rom.read(16)
-        print header
-        (self.header, self.prg_count, self.chr_count, \
-         self.mapping1, self.mapping2) = \
-         struct.unpack("4sBBBB8x", header)
-        if self.header[:4] != "NES\x1a":
+        if self.rom is None:
+            return False
+        try:
+            self.data = mmap.mmap(self.rom.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            print "Unable to map ROM file: %s" % self.filename
+            return False
+        try:
+            self.header = NESHeader(self.data[:16])
+        except PyNESException:
             print "Checksum does not match!"
             return False
+        self.prg_count = self.header.prg_size / 0x4000
+        self.chr_count = self.header.chr_size / 0x2000
+        self.mapping1 = self.header.mapping1
+        self.mapping2 = self.header.mapping2
         print "PRG: %d, CHR: %d, Mapping1: 0x%x, Mapping2: 0x%x" % \
              (self.prg_count, self.chr_count, self.mapping1, self.mapping2)
+        
+        offset = 16
+        self.trainer = None
+        if self.header.trainer:
+            self.trainer = buffer(self.data, offset, 512)
+            offset += 512
+        if offset + self.prg_count * 0x4000 + self.chr_count * 0x2000 > len(self.data):
+            print "ROM file is shorter than its header claims!"
+            return False
+        self.prgs = []
         for i in range(self.prg_count):
-            self.prgs.append(self.rom.read(16384))
+            self.prgs.append(buffer(self.data, offset, 0x4000))
+            offset += 0x4000
+        self.chrs = []
         for i in range(self.chr_count):
-            self.chrs.append(self.rom.read(8192))
-        self.title = self.rom.read(128)
+            self.chrs.append(buffer(self.data, offset, 0x2000))
+            offset += 0x2000
+        # Some dumps carry a 128 byte title after the CHR data
+        self.title = self.data[offset:offset+128]
         
         if self.prg_count == 1:
-            #Mapper 0 (?), mirror memory into both banks
-            self.prgs.append(self.prgs[0])
+            #Mapper 0 (?), mirror the bank into both windows
+            self.prg_windows = [self.prgs[0], self.prgs[0]]
+        elif self.prg_count > 1:
+            self.prg_windows = [self.prgs[0], self.prgs[1]]
+        else:
+            self.prg_windows = []
+        return True
     
     def read_memory(self, addr, length):
         #TODO: handle more than 2 banks
-        if addr < 0xC000 and addr >= 0x8000:
-            offset = addr-0x8000
-            return self.prgs[0][offset:offset+length]
-        elif addr >= 0xC000 and addr <= 0xFFFF:
-            offset = addr-0x8000
-            return self.prgs[1][offset:offset+length]
+        if addr >= 0x8000 and addr <= 0xFFFF:
+            offset = addr & 0x3FFF
+            return self.prg_windows[(addr >> 14) & 1][offset:offset+length]
     
     def make_sprite(self, data):
         smap = {('0','0'):0, ('0','1'):2, ('1','0'):1, ('1','1'):3}
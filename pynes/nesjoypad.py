@@ -0,0 +1,49 @@
+from pynes import *
+
+# Button bits, in the order the controller shifts them out
+BUTTONS = ['A', 'B', 'SELECT', 'START', 'UP', 'DOWN', 'LEFT', 'RIGHT']
+
+# Reference: http://wiki.nesdev.com/w/index.php/Standard_controller
+class NES_Joypad:
+    def __init__(self, nes_core, port):
+        self.nes_core = nes_core
+        self.port = port
+        self.buttons = 0
+        self.strobe = False
+        self.index = 0
+    
+    def set_buttons(self, buttons):
+        # buttons: bitmask in BUTTONS order, or a list of button names
+        if isinstance(buttons, (list, tuple)):
+            mask = 0
+            for name in buttons:
+                if name.upper() not in BUTTONS:
+                    raise PyNESException("Unknown button: %s" % name)
+                mask |= 1 << BUTTONS.index(name.upper())
+            buttons = mask
+        self.buttons = buttons & 0xFF
+    
+    def write_strobe(self, value):
+        self.strobe = bool(value & 1)
+        if self.strobe:
+            self.index = 0
+    
+    # Called before the core reads the port, so the bit is left in memory
+    # for read_memory to return
+    def read(self):
+        if self.index < 8:
+            bit = (self.buttons >> self.index) & 1
+        else:
+            bit = 1
+        if not self.strobe:
+            self.index += 1
+        self.nes_core.memory[self.port] = 0x40 | bit
+    
+    def do_joypad_access(self, is_write, val):
+        if is_write:
+            # A write to $4016 strobes both controllers
+            value = ord(val[0])
+            for joypad in self.nes_core.joypads:
+                joypad.write_strobe(value)
+        else:
+            self.read()
@@ -0,0 +1,349 @@
+import hashlib
+import imp
+import marshal
+import os
+
+from pynes import *
+
+# 6502 instruction set, official opcodes plus the stable unofficial ones.
+# Every opcode gets its own handler, generated from the addressing mode and
+# operation templates below, so handlers never branch on the opcode or the
+# addressing mode at run time.
+# Reference: http://www.obelisk.me.uk/6502/reference.html
+#            http://wiki.nesdev.com/w/index.php/CPU_unofficial_opcodes
+
+# Addressing modes: name -> (instruction length, operand syntax)
+MODES = {
+    'imp': (1, ''),
+    'acc': (1, 'A'),
+    'imm': (2, '#$%02x'),
+    'zp':  (2, '$%02x'),
+    'zpx': (2, '$%02x,X'),
+    'zpy': (2, '$%02x,Y'),
+    'abs': (3, '$%04x'),
+    'abx': (3, '$%04x,X'),
+    'aby': (3, '$%04x,Y'),
+    'ind': (3, '($%04x)'),
+    'izx': (2, '($%02x,X)'),
+    'izy': (2, '($%02x),Y'),
+    'rel': (2, '$%04x'),
+}
+
+# (opcode, mnemonic, addressing mode, base cycles, +1 cycle on page cross)
+OPCODES = [
+    (0x69, 'ADC', 'imm', 2, 0), (0x65, 'ADC', 'zp', 3, 0), (0x75, 'ADC', 'zpx', 4, 0),
+    (0x6D, 'ADC', 'abs', 4, 0), (0x7D, 'ADC', 'abx', 4, 1), (0x79, 'ADC', 'aby', 4, 1),
+    (0x61, 'ADC', 'izx', 6, 0), (0x71, 'ADC', 'izy', 5, 1),
+    (0x29, 'AND', 'imm', 2, 0), (0x25, 'AND', 'zp', 3, 0), (0x35, 'AND', 'zpx', 4, 0),
+    (0x2D, 'AND', 'abs', 4, 0), (0x3D, 'AND', 'abx', 4, 1), (0x39, 'AND', 'aby', 4, 1),
+    (0x21, 'AND', 'izx', 6, 0), (0x31, 'AND', 'izy', 5, 1),
+    (0x0A, 'ASL', 'acc', 2, 0), (0x06, 'ASL', 'zp', 5, 0), (0x16, 'ASL', 'zpx', 6, 0),
+    (0x0E, 'ASL', 'abs', 6, 0), (0x1E, 'ASL', 'abx', 7, 0),
+    (0x90, 'BCC', 'rel', 2, 0), (0xB0, 'BCS', 'rel', 2, 0), (0xF0, 'BEQ', 'rel', 2, 0),
+    (0x30, 'BMI', 'rel', 2, 0), (0xD0, 'BNE', 'rel', 2, 0), (0x10, 'BPL', 'rel', 2, 0),
+    (0x50, 'BVC', 'rel', 2, 0), (0x70, 'BVS', 'rel', 2, 0),
+    (0x24, 'BIT', 'zp', 3, 0), (0x2C, 'BIT', 'abs', 4, 0),
+    (0x00, 'BRK', 'imp', 7, 0),
+    (0x18, 'CLC', 'imp', 2, 0), (0xD8, 'CLD', 'imp', 2, 0), (0x58, 'CLI', 'imp', 2, 0),
+    (0xB8, 'CLV', 'imp', 2, 0),
+    (0xC9, 'CMP', 'imm', 2, 0), (0xC5, 'CMP', 'zp', 3, 0), (0xD5, 'CMP', 'zpx', 4, 0),
+    (0xCD, 'CMP', 'abs', 4, 0), (0xDD, 'CMP', 'abx', 4, 1), (0xD9, 'CMP', 'aby', 4, 1),
+    (0xC1, 'CMP', 'izx', 6, 0), (0xD1, 'CMP', 'izy', 5, 1),
+    (0xE0, 'CPX', 'imm', 2, 0), (0xE4, 'CPX', 'zp', 3, 0), (0xEC, 'CPX', 'abs', 4, 0),
+    (0xC0, 'CPY', 'imm', 2, 0), (0xC4, 'CPY', 'zp', 3, 0), (0xCC, 'CPY', 'abs', 4, 0),
+    (0xC6, 'DEC', 'zp', 5, 0), (0xD6, 'DEC', 'zpx', 6, 0), (0xCE, 'DEC', 'abs', 6, 0),
+    (0xDE, 'DEC', 'abx', 7, 0),
+    (0xCA, 'DEX', 'imp', 2, 0), (0x88, 'DEY', 'imp', 2, 0),
+    (0x49, 'EOR', 'imm', 2, 0), (0x45, 'EOR', 'zp', 3, 0), (0x55, 'EOR', 'zpx', 4, 0),
+    (0x4D, 'EOR', 'abs', 4, 0), (0x5D, 'EOR', 'abx', 4, 1), (0x59, 'EOR', 'aby', 4, 1),
+    (0x41, 'EOR', 'izx', 6, 0), (0x51, 'EOR', 'izy', 5, 1),
+    (0xE6, 'INC', 'zp', 5, 0), (0xF6, 'INC', 'zpx', 6, 0), (0xEE, 'INC', 'abs', 6, 0),
+    (0xFE, 'INC', 'abx', 7, 0),
+    (0xE8, 'INX', 'imp', 2, 0), (0xC8, 'INY', 'imp', 2, 0),
+    (0x4C, 'JMP', 'abs', 3, 0), (0x6C, 'JMP', 'ind', 5, 0),
+    (0x20, 'JSR', 'abs', 6, 0),
+    (0xA9, 'LDA', 'imm', 2, 0), (0xA5, 'LDA', 'zp', 3, 0), (0xB5, 'LDA', 'zpx', 4, 0),
+    (0xAD, 'LDA', 'abs', 4, 0), (0xBD, 'LDA', 'abx', 4, 1), (0xB9, 'LDA', 'aby', 4, 1),
+    (0xA1, 'LDA', 'izx', 6, 0), (0xB1, 'LDA', 'izy', 5, 1),
+    (0xA2, 'LDX', 'imm', 2, 0), (0xA6, 'LDX', 'zp', 3, 0), (0xB6, 'LDX', 'zpy', 4, 0),
+    (0xAE, 'LDX', 'abs', 4, 0), (0xBE, 'LDX', 'aby', 4, 1),
+    (0xA0, 'LDY', 'imm', 2, 0), (0xA4, 'LDY', 'zp', 3, 0), (0xB4, 'LDY', 'zpx', 4, 0),
+    (0xAC, 'LDY', 'abs', 4, 0), (0xBC, 'LDY', 'abx', 4, 1),
+    (0x4A, 'LSR', 'acc', 2, 0), (0x46, 'LSR', 'zp', 5, 0), (0x56, 'LSR', 'zpx', 6, 0),
+    (0x4E, 'LSR', 'abs', 6, 0), (0x5E, 'LSR', 'abx', 7, 0),
+    (0xEA, 'NOP', 'imp', 2, 0),
+    (0x09, 'ORA', 'imm', 2, 0), (0x05, 'ORA', 'zp', 3, 0), (0x15, 'ORA', 'zpx', 4, 0),
+    (0x0D, 'ORA', 'abs', 4, 0), (0x1D, 'ORA', 'abx', 4, 1), (0x19, 'ORA', 'aby', 4, 1),
+    (0x01, 'ORA', 'izx', 6, 0), (0x11, 'ORA', 'izy', 5, 1),
+    (0x48, 'PHA', 'imp', 3, 0), (0x08, 'PHP', 'imp', 3, 0), (0x68, 'PLA', 'imp', 4, 0),
+    (0x28, 'PLP', 'imp', 4, 0),
+    (0x2A, 'ROL', 'acc', 2, 0), (0x26, 'ROL', 'zp', 5, 0), (0x36, 'ROL', 'zpx', 6, 0),
+    (0x2E, 'ROL', 'abs', 6, 0), (0x3E, 'ROL', 'abx', 7, 0),
+    (0x6A, 'ROR', 'acc', 2, 0), (0x66, 'ROR', 'zp', 5, 0), (0x76, 'ROR', 'zpx', 6, 0),
+    (0x6E, 'ROR', 'abs', 6, 0), (0x7E, 'ROR', 'abx', 7, 0),
+    (0x40, 'RTI', 'imp', 6, 0), (0x60, 'RTS', 'imp', 6, 0),
+    (0xE9, 'SBC', 'imm', 2, 0), (0xE5, 'SBC', 'zp', 3, 0), (0xF5, 'SBC', 'zpx', 4, 0),
+    (0xED, 'SBC', 'abs', 4, 0), (0xFD, 'SBC', 'abx', 4, 1), (0xF9, 'SBC', 'aby', 4, 1),
+    (0xE1, 'SBC', 'izx', 6, 0), (0xF1, 'SBC', 'izy', 5, 1),
+    (0x38, 'SEC', 'imp', 2, 0), (0xF8, 'SED', 'imp', 2, 0), (0x78, 'SEI', 'imp', 2, 0),
+    (0x85, 'STA', 'zp', 3, 0), (0x95, 'STA', 'zpx', 4, 0), (0x8D, 'STA', 'abs', 4, 0),
+    (0x9D, 'STA', 'abx', 5, 0), (0x99, 'STA', 'aby', 5, 0), (0x81, 'STA', 'izx', 6, 0),
+    (0x91, 'STA', 'izy', 6, 0),
+    (0x86, 'STX', 'zp', 3, 0), (0x96, 'STX', 'zpy', 4, 0), (0x8E, 'STX', 'abs', 4, 0),
+    (0x84, 'STY', 'zp', 3, 0), (0x94, 'STY', 'zpx', 4, 0), (0x8C, 'STY', 'abs', 4, 0),
+    (0xAA, 'TAX', 'imp', 2, 0), (0xA8, 'TAY', 'imp', 2, 0), (0xBA, 'TSX', 'imp', 2, 0),
+    (0x8A, 'TXA', 'imp', 2, 0), (0x9A, 'TXS', 'imp', 2, 0), (0x98, 'TYA', 'imp', 2, 0),
+
+    # Unofficial
+    (0x1A, 'NOP', 'imp', 2, 0), (0x3A, 'NOP', 'imp', 2, 0), (0x5A, 'NOP', 'imp', 2, 0),
+    (0x7A, 'NOP', 'imp', 2, 0), (0xDA, 'NOP', 'imp', 2, 0), (0xFA, 'NOP', 'imp', 2, 0),
+    (0x80, 'NOP', 'imm', 2, 0), (0x82, 'NOP', 'imm', 2, 0), (0x89, 'NOP', 'imm', 2, 0),
+    (0xC2, 'NOP', 'imm', 2, 0), (0xE2, 'NOP', 'imm', 2, 0),
+    (0x04, 'NOP', 'zp', 3, 0), (0x44, 'NOP', 'zp', 3, 0), (0x64, 'NOP', 'zp', 3, 0),
+    (0x14, 'NOP', 'zpx', 4, 0), (0x34, 'NOP', 'zpx', 4, 0), (0x54, 'NOP', 'zpx', 4, 0),
+    (0x74, 'NOP', 'zpx', 4, 0), (0xD4, 'NOP', 'zpx', 4, 0), (0xF4, 'NOP', 'zpx', 4, 0),
+    (0x0C, 'NOP', 'abs', 4, 0),
+    (0x1C, 'NOP', 'abx', 4, 1), (0x3C, 'NOP', 'abx', 4, 1), (0x5C, 'NOP', 'abx', 4, 1),
+    (0x7C, 'NOP', 'abx', 4, 1), (0xDC, 'NOP', 'abx', 4, 1), (0xFC, 'NOP', 'abx', 4, 1),
+    (0xA7, 'LAX', 'zp', 3, 0), (0xB7, 'LAX', 'zpy', 4, 0), (0xAF, 'LAX', 'abs', 4, 0),
+    (0xBF, 'LAX', 'aby', 4, 1), (0xA3, 'LAX', 'izx', 6, 0), (0xB3, 'LAX', 'izy', 5, 1),
+    (0x87, 'SAX', 'zp', 3, 0), (0x97, 'SAX', 'zpy', 4, 0), (0x8F, 'SAX', 'abs', 4, 0),
+    (0x83, 'SAX', 'izx', 6, 0),
+    (0xEB, 'SBC', 'imm', 2, 0),
+    (0xC7, 'DCP', 'zp', 5, 0), (0xD7, 'DCP', 'zpx', 6, 0), (0xCF, 'DCP', 'abs', 6, 0),
+    (0xDF, 'DCP', 'abx', 7, 0), (0xDB, 'DCP', 'aby', 7, 0), (0xC3, 'DCP', 'izx', 8, 0),
+    (0xD3, 'DCP', 'izy', 8, 0),
+    (0xE7, 'ISB', 'zp', 5, 0), (0xF7, 'ISB', 'zpx', 6, 0), (0xEF, 'ISB', 'abs', 6, 0),
+    (0xFF, 'ISB', 'abx', 7, 0), (0xFB, 'ISB', 'aby', 7, 0), (0xE3, 'ISB', 'izx', 8, 0),
+    (0xF3, 'ISB', 'izy', 8, 0),
+    (0x07, 'SLO', 'zp', 5, 0), (0x17, 'SLO', 'zpx', 6, 0), (0x0F, 'SLO', 'abs', 6, 0),
+    (0x1F, 'SLO', 'abx', 7, 0), (0x1B, 'SLO', 'aby', 7, 0), (0x03, 'SLO', 'izx', 8, 0),
+    (0x13, 'SLO', 'izy', 8, 0),
+    (0x27, 'RLA', 'zp', 5, 0), (0x37, 'RLA', 'zpx', 6, 0), (0x2F, 'RLA', 'abs', 6, 0),
+    (0x3F, 'RLA', 'abx', 7, 0), (0x3B, 'RLA', 'aby', 7, 0), (0x23, 'RLA', 'izx', 8, 0),
+    (0x33, 'RLA', 'izy', 8, 0),
+    (0x47, 'SRE', 'zp', 5, 0), (0x57, 'SRE', 'zpx', 6, 0), (0x4F, 'SRE', 'abs', 6, 0),
+    (0x5F, 'SRE', 'abx', 7, 0), (0x5B, 'SRE', 'aby', 7, 0), (0x43, 'SRE', 'izx', 8, 0),
+    (0x53, 'SRE', 'izy', 8, 0),
+    (0x67, 'RRA', 'zp', 5, 0), (0x77, 'RRA', 'zpx', 6, 0), (0x6F, 'RRA', 'abs', 6, 0),
+    (0x7F, 'RRA', 'abx', 7, 0), (0x7B, 'RRA', 'aby', 7, 0), (0x63, 'RRA', 'izx', 8, 0),
+    (0x73, 'RRA', 'izy', 8, 0),
+    (0x0B, 'ANC', 'imm', 2, 0), (0x2B, 'ANC', 'imm', 2, 0), (0x4B, 'ALR', 'imm', 2, 0),
+    (0x6B, 'ARR', 'imm', 2, 0), (0xCB, 'AXS', 'imm', 2, 0),
+]
+
+# Code computing 'addr' for each addressing mode. Page crossing checks are
+# only emitted for opcodes that pay for them.
+ADDRESS_CODE = {
+    'zp':  "addr = ord(data[1])",
+    'zpx': "addr = (ord(data[1]) + self.X) & 0xFF",
+    'zpy': "addr = (ord(data[1]) + self.Y) & 0xFF",
+    'abs': "addr = ord(data[1]) | ord(data[2]) << 8",
+    'abx': "base = ord(data[1]) | ord(data[2]) << 8\n"
+           "addr = (base + self.X) & 0xFFFF",
+    'aby': "base = ord(data[1]) | ord(data[2]) << 8\n"
+           "addr = (base + self.Y) & 0xFFFF",
+    # The pointer's high byte is fetched without carrying into the next page
+    'ind': "ptr = ord(data[1]) | ord(data[2]) << 8\n"
+           "addr = ord(self.read_memory(ptr, 1)) | "
+           "ord(self.read_memory((ptr & 0xFF00) | ((ptr + 1) & 0xFF), 1)) << 8",
+    'izx': "ptr = (ord(data[1]) + self.X) & 0xFF\n"
+           "addr = ord(self.read_memory(ptr, 1)) | ord(self.read_memory((ptr + 1) & 0xFF, 1)) << 8",
+    'izy': "ptr = ord(data[1])\n"
+           "base = ord(self.read_memory(ptr, 1)) | ord(self.read_memory((ptr + 1) & 0xFF, 1)) << 8\n"
+           "addr = (base + self.Y) & 0xFFFF",
+}
+PAGE_CROSS_CODE = "if (base ^ addr) & 0xFF00:\n    self.cycle_count += 1"
+
+# Operation templates. READ is replaced with the operand value, WRITE with
+# a store of 'v' back to the operand (memory or A).
+SET_NZ = "P['Z'] = v == 0\nP['N'] = v >> 7"
+ADD = "a = self.A\n" \
+      "r = a + m + P['C']\n" \
+      "P['C'] = r > 0xFF\n" \
+      "v = r & 0xFF\n" \
+      "P['V'] = (a ^ v) & (m ^ v) & 0x80 != 0\n" \
+      "self.A = v\n" + SET_NZ
+COMPARE = "r = %s - m\nP['C'] = r >= 0\nv = r & 0xFF\n" + SET_NZ
+ASL = "v = READ\nP['C'] = v >> 7\nv = (v << 1) & 0xFF\nWRITE\n"
+LSR = "v = READ\nP['C'] = v & 1\nv >>= 1\nWRITE\n"
+ROL = "v = READ\nc = P['C']\nP['C'] = v >> 7\nv = ((v << 1) & 0xFF) | c\nWRITE\n"
+ROR = "v = READ\nc = P['C']\nP['C'] = v & 1\nv = (v >> 1) | (c << 7)\nWRITE\n"
+DEC = "v = (READ - 1) & 0xFF\nWRITE\n"
+INC = "v = (READ + 1) & 0xFF\nWRITE\n"
+BRANCH = "if %s:\n" \
+         "    pc = self.PC + 2\n" \
+         "    target = (pc + SIGNED[ord(data[1])]) & 0xFFFF\n" \
+         "    self.cycle_count += 2 if (pc ^ target) & 0xFF00 else 1\n" \
+         "    return target"
+
+OPERATIONS = {
+    'ADC': "m = READ\n" + ADD,
+    'SBC': "m = READ ^ 0xFF\n" + ADD,
+    'AND': "v = self.A & READ\nself.A = v\n" + SET_NZ,
+    'ORA': "v = self.A | READ\nself.A = v\n" + SET_NZ,
+    'EOR': "v = self.A ^ READ\nself.A = v\n" + SET_NZ,
+    'CMP': "m = READ\n" + COMPARE % 'self.A',
+    'CPX': "m = READ\n" + COMPARE % 'self.X',
+    'CPY': "m = READ\n" + COMPARE % 'self.Y',
+    'BIT': "m = READ\nP['Z'] = self.A & m == 0\nP['V'] = (m >> 6) & 1\nP['N'] = m >> 7",
+    'LDA': "v = READ\nself.A = v\n" + SET_NZ,
+    'LDX': "v = READ\nself.X = v\n" + SET_NZ,
+    'LDY': "v = READ\nself.Y = v\n" + SET_NZ,
+    'STA': "v = self.A\nWRITE",
+    'STX': "v = self.X\nWRITE",
+    'STY': "v = self.Y\nWRITE",
+    'ASL': ASL + SET_NZ,
+    'LSR': LSR + SET_NZ,
+    'ROL': ROL + SET_NZ,
+    'ROR': ROR + SET_NZ,
+    'DEC': DEC + SET_NZ,
+    'INC': INC + SET_NZ,
+    'DEX': "v = (self.X - 1) & 0xFF\nself.X = v\n" + SET_NZ,
+    'DEY': "v = (self.Y - 1) & 0xFF\nself.Y = v\n" + SET_NZ,
+    'INX': "v = (self.X + 1) & 0xFF\nself.X = v\n" + SET_NZ,
+    'INY': "v = (self.Y + 1) & 0xFF\nself.Y = v\n" + SET_NZ,
+    'TAX': "v = self.A\nself.X = v\n" + SET_NZ,
+    'TAY': "v = self.A\nself.Y = v\n" + SET_NZ,
+    'TXA': "v = self.X\nself.A = v\n" + SET_NZ,
+    'TYA': "v = self.Y\nself.A = v\n" + SET_NZ,
+    'TSX': "v = self.S\nself.X = v\n" + SET_NZ,
+    'TXS': "self.S = self.X",
+    'CLC': "P['C'] = 0",
+    'CLD': "P['D'] = 0",
+    'CLI': "P['I'] = 0",
+    'CLV': "P['V'] = 0",
+    'SEC': "P['C'] = 1",
+    'SED': "P['D'] = 1",
+    'SEI': "P['I'] = 1",
+    'BCC': BRANCH % "not P['C']",
+    'BCS': BRANCH % "P['C']",
+    'BNE': BRANCH % "not P['Z']",
+    'BEQ': BRANCH % "P['Z']",
+    'BPL': BRANCH % "not P['N']",
+    'BMI': BRANCH % "P['N']",
+    'BVC': BRANCH % "not P['V']",
+    'BVS': BRANCH % "P['V']",
+    'JMP': "return addr",
+    'JSR': "self.push_word(self.PC + 2)\nreturn addr",
+    'RTS': "return (self.pop_word() + 1) & 0xFFFF",
+    'RTI': "self.set_all_flags(self.pop_stack())\nreturn self.pop_word()",
+    'BRK': "self.push_word(self.PC + 2)\n"
+           "self.push_stack(self.get_all_flags() | 0x10)\n"
+           "P['I'] = 1\n"
+           "return self.irq",
+    'PHA': "self.push_stack(self.A)",
+    'PHP': "self.push_stack(self.get_all_flags() | 0x10)",
+    'PLA': "v = self.pop_stack()\nself.A = v\n" + SET_NZ,
+    'PLP': "self.set_all_flags(self.pop_stack())",
+    'NOP': "pass",
+
+    # Unofficial
+    'LAX': "v = READ\nself.A = self.X = v\n" + SET_NZ,
+    'SAX': "v = self.A & self.X\nWRITE",
+    'DCP': DEC + "m = v\n" + COMPARE % 'self.A',
+    'ISB': INC + "m = v ^ 0xFF\n" + ADD,
+    'SLO': ASL + "v |= self.A\nself.A = v\n" + SET_NZ,
+    'RLA': ROL + "v &= self.A\nself.A = v\n" + SET_NZ,
+    'SRE': LSR + "v ^= self.A\nself.A = v\n" + SET_NZ,
+    'RRA': ROR + "m = v\n" + ADD,
+    'ANC': "v = self.A & READ\nself.A = v\n" + SET_NZ + "\nP['C'] = P['N']",
+    'ALR': "v = self.A & READ\nP['C'] = v & 1\nv >>= 1\nself.A = v\n" + SET_NZ,
+    'ARR': "v = ((self.A & READ) >> 1) | (P['C'] << 7)\nself.A = v\n" + SET_NZ + "\n"
+           "P['C'] = (v >> 6) & 1\nP['V'] = ((v >> 6) ^ (v >> 5)) & 1",
+    'AXS': "r = (self.A & self.X) - READ\nP['C'] = r >= 0\nv = r & 0xFF\nself.X = v\n" + SET_NZ,
+}
+
+# Signed value of a relative branch offset byte
+SIGNED = [i - 0x100 if i & 0x80 else i for i in range(0x100)]
+
+def handler_source(name, mnemonic, mode, page_penalty):
+    body = OPERATIONS[mnemonic]
+    lines = []
+    if mode in ADDRESS_CODE:
+        lines.append(ADDRESS_CODE[mode])
+        if page_penalty:
+            lines.append(PAGE_CROSS_CODE)
+    if mode == 'imm':
+        read = "ord(data[1])"
+    elif mode == 'acc':
+        read = "self.A"
+    else:
+        read = "ord(self.read_memory(addr, 1))"
+    if mode == 'acc':
+        write = "self.A = v"
+    else:
+        write = "self.write_memory(addr, chr(v))"
+    body = body.replace('READ', read).replace('WRITE', write)
+    if "P[" in body:
+        lines.append("P = self.P")
+    lines.append(body)
+    code = '\n'.join(lines).replace('\n', '\n    ')
+    return "def %s(self, data):\n    %s\n" % (name, code)
+
+# Compiled handlers are cached next to this module, keyed by a hash of the
+# tables, the generator and the interpreter's bytecode format, so only the
+# first run after a change pays for compiling them
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nesops.cache')
+
+def cache_key():
+    key = hashlib.sha1(imp.get_magic())
+    key.update(repr((sorted(MODES.items()), OPCODES, sorted(ADDRESS_CODE.items()),
+                     PAGE_CROSS_CODE, sorted(OPERATIONS.items()))))
+    key.update(marshal.dumps(handler_source.func_code))
+    return key.hexdigest()
+
+def compile_handlers():
+    handlers = []
+    for (opcode, mnemonic, mode, cycles, page_penalty) in OPCODES:
+        source = handler_source("do_%s" % mnemonic.lower(), mnemonic, mode, page_penalty)
+        handlers.append((opcode, compile(source, "<nesops $%02x>" % opcode, 'exec')))
+    return handlers
+
+def load_handlers():
+    key = cache_key()
+    try:
+        data = open(CACHE_PATH, 'rb').read()
+        if data[:len(key)] == key:
+            return marshal.loads(data[len(key):])
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    
+    handlers = compile_handlers()
+    # Only needed when the cache is rebuilt
+    import tempfile
+    try:
+        # Written under a temporary name and renamed, so processes starting
+        # at the same time never read a partial cache
+        (fd, tmp_path) = tempfile.mkstemp(prefix='.nesops', dir=os.path.dirname(CACHE_PATH))
+    except (IOError, OSError):
+        # Read-only install: compile again next time
+        return handlers
+    try:
+        out = os.fdopen(fd, 'wb')
+        out.write(key + marshal.dumps(handlers))
+        out.close()
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, CACHE_PATH)
+    except (IOError, OSError):
+        # E.g. a full disk: don't leave the partial file behind
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+    return handlers
+
+# Opcode byte -> (handler, length, cycles, mnemonic, addressing mode), the
+# layout of NESProc.INST_SET. Handlers are called as handler(core, data) and
+# return the new PC for control transfers, None otherwise.
+def build_instruction_set():
+    table = dict((opcode, (mnemonic, mode, cycles)) for \
+        (opcode, mnemonic, mode, cycles, page_penalty) in OPCODES)
+    inst_set = {}
+    for (opcode, code) in load_handlers():
+        (mnemonic, mode, cycles) = table[opcode]
+        namespace = {'SIGNED': SIGNED}
+        exec code in namespace
+        handler = namespace["do_%s" % mnemonic.lower()]
+        inst_set[chr(opcode)] = (handler, MODES[mode][0], cycles, mnemonic, mode)
+    return inst_set
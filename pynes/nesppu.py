@@ -1,30 +1,33 @@
 import struct
-import logging
 
 from pynes import *
+from nesvideo import FRAME_WIDTH, FRAME_HEIGHT, FRAME_SIZE, BLANK_COLOR
+
+PALETTE = [(0x75,0x75,0x75), (0x27, 0x1B, 0x8F), (0x37, 0x00, 0xBF), (0x84, 0x00, 0xA6), \
+           (0xBB,0x00,0x6A), (0xB7,0x00,0x1E), (0xB3,0x00,0x00), (0x91,0x26,0x00),
+           (0x7B,0x2B,0x00), (0x00,0x3E,0x00), (0x00,0x48,0x0D), (0x00,0x3C,0x22),
+           (0x00,0x2F,0x66), (0x00,0x00,0x00), (0x00,0x00,0x00), (0x05,0x05,0x05),
+
+           (0xC8,0xC8,0xC8), (0x00,0x59,0xFF), (0x44,0x3C,0xFF), (0xB7,0x33,0xCC),
+           (0xFF,0x33,0xAA), (0xFF,0x37,0x5E), (0xFF,0x37,0x1A), (0xD5,0x4B,0x00),
+           (0xC4,0x62,0x00), (0x3C,0x7B,0x00), (0x1E,0x84,0x15), (0x00,0x95,0x66),
+           (0x00,0x84,0xC4), (0x11,0x11,0x11), (0x09,0x09,0x09), (0x09,0x09,0x09),
+
+           (0xFF,0xFF,0xFF), (0x00,0x95,0xFF), (0x6F,0x84,0xFF), (0xD5,0x6F,0xFF),
+           (0xFF,0x77,0xCC), (0xFF,0x6F,0x99), (0xFF,0x7B,0x59), (0xFF,0x91,0x5F),
+           (0xFF,0xA2,0x33), (0xA6,0xBF,0x00), (0x51,0xD9,0x6A), (0x4D,0xD5,0xAE),
+           (0x00,0xD9,0xFF), (0x66,0x66,0x66), (0x0D,0x0D,0x0D), (0x0D,0x0D,0x0D),
+
+           (0xFF,0xFF,0xFF), (0x84,0xBF,0xFF), (0xBB,0xBB,0xFF), (0xD0,0xBB,0xFF),
+           (0xFF,0xBF,0xEA), (0xFF,0xBF,0xCC), (0xFF,0xC4,0xB7), (0xFF,0xCC,0xAE),
+           (0xFF,0xD9,0xA2), (0xCC,0xE1,0x99), (0xAE,0xEE,0xB7), (0xAA,0xF7,0xEE),
+           (0xB3,0xEE,0xFF), (0xDD,0xDD,0xDD), (0x11,0x11,0x11), (0x11,0x11,0x11)]
+
+BLANK_FRAME = chr(BLANK_COLOR) * FRAME_SIZE
 
 class NES_PPU:
     def __init__(self, nes_core, log_level='warning'):
-        self.palette = [(0x75,0x75,0x75), (0x27, 0x1B, 0x8F), (0x37, 0x00, 0xBF), (0x84, 0x00, 0xA6), \
-                        (0xBB,0x00,0x6A), (0xB7,0x00,0x1E), (0xB3,0x00,0x00), (0x91,0x26,0x00),
-                        (0x7B,0x2B,0x00), (0x00,0x3E,0x00), (0x00,0x48,0x0D), (0x00,0x3C,0x22),
-                        (0x00,0x2F,0x66), (0x00,0x00,0x00), (0x00,0x00,0x00), (0x05,0x05,0x05),
-            
-                        (0xC8,0xC8,0xC8), (0x00,0x59,0xFF), (0x44,0x3C,0xFF), (0xB7,0x33,0xCC),
-                        (0xFF,0x33,0xAA), (0xFF,0x37,0x5E), (0xFF,0x37,0x1A), (0xD5,0x4B,0x00),
-                        (0xC4,0x62,0x00), (0x3C,0x7B,0x00), (0x1E,0x84,0x15), (0x00,0x95,0x66),
-                        (0x00,0x84,0xC4), (0x11,0x11,0x11), (0x09,0x09,0x09), (0x09,0x09,0x09),
-            
-                        (0xFF,0xFF,0xFF), (0x00,0x95,0xFF), (0x6F,0x84,0xFF), (0xD5,0x6F,0xFF),
-                        (0xFF,0x77,0xCC), (0xFF,0x6F,0x99), (0xFF,0x7B,0x59), (0xFF,0x91,0x5F),
-                        (0xFF,0xA2,0x33), (0xA6,0xBF,0x00), (0x51,0xD9,0x6A), (0x4D,0xD5,0xAE),
-                        (0x00,0xD9,0xFF), (0x66,0x66,0x66), (0x0D,0x0D,0x0D), (0x0D,0x0D,0x0D),
-            
-                        (0xFF,0xFF,0xFF), (0x84,0xBF,0xFF), (0xBB,0xBB,0xFF), (0xD0,0xBB,0xFF),
-                        (0xFF,0xBF,0xEA), (0xFF,0xBF,0xCC), (0xFF,0xC4,0xB7), (0xFF,0xCC,0xAE),
-                        (0xFF,0xD9,0xA2), (0xCC,0xE1,0x99), (0xAE,0xEE,0xB7), (0xAA,0xF7,0xEE),
-                        (0xB3,0xEE,0xFF), (0xDD,0xDD,0xDD), (0x11,0x11,0x11), (0x11,0x11,0x11)]
-        
+        self.palette = PALETTE
         self.nes_core = nes_core
         
         self.PPU_low = None
@@ -34,13 +37,10 @@ class NES_PPU:
         self.PPU_pattern_table = 0x0000
         self.vram = bytearray(0x4000)      #16kb of PPU RAM
         self.spr_ram = bytearray(0x100)    # 256 bytes of SPR-RAM
-        self.sprites = [None]*64
+        # Pattern tables: the cart's CHR-ROM bank if it has one, else CHR-RAM
+        self.pattern_mem = self.vram
         
-        self.log = logging.getLogger("6502-ppu")
-        self.ch = logging.StreamHandler()
-        self.ch.setLevel(logging.DEBUG)
-        self.log.addHandler(self.ch)
-        self.log.setLevel(LEVELS[log_level])
+        self.log = get_logger("6502-ppu", log_level)
         self.loglevel = LEVELS[log_level]
         self.logEnabled = True#self.nes_core.logEnabled
     
@@ -94,4 +94,49 @@ class NES_PPU:
         else:
             if self.logEnabled: self.log.warning("Trying to access PPU memory with invalid PPU address")
         if ret:
-            return ret
\ No newline at end of file
+            return ret
+    
+    def save_state(self):
+        return {'regs': (self.PPU_low, self.PPU_high, self.PPU_addr, \
+                         self.PPU_vblank_enable, self.PPU_pattern_table),
+                'vram': str(self.vram),
+                'spr_ram': str(self.spr_ram)}
+    
+    def load_state(self, state):
+        (self.PPU_low, self.PPU_high, self.PPU_addr, \
+         self.PPU_vblank_enable, self.PPU_pattern_table) = state['regs']
+        self.vram[:] = state['vram']
+        self.spr_ram = bytearray(state['spr_ram'])
+    
+    def render_sprite(self, frame, data, x_pos, y_pos, attr):
+        palette_base = 0x3f00 + ((attr & 0x3) << 2)
+        for y in range(8):
+            row = y_pos + y
+            if row >= FRAME_HEIGHT:
+                break
+            low_byte = data[y]
+            high_byte = data[8+y]
+            offset = row * FRAME_WIDTH
+            for x in range(8):
+                col = x_pos + x
+                if col >= FRAME_WIDTH:
+                    break
+                bit = 0x80 >> x
+                color_sel = 0
+                if low_byte & bit:
+                    color_sel |= 1
+                if high_byte & bit:
+                    color_sel |= 2
+                if color_sel:
+                    frame[offset+col] = self.vram[palette_base+color_sel] & 0x3F
+    
+    # Draw the current sprites into 'frame', a bytearray of palette indices
+    def render_frame(self, frame):
+        frame[:] = BLANK_FRAME
+        for i in range(0, 256, 4):
+            (y_pos, pat_num, attr, x_pos) = struct.unpack("BBBB", str(self.spr_ram[i:i+4]))
+            if not pat_num:
+                continue
+            addr = self.PPU_pattern_table + pat_num*0x10
+            self.render_sprite(frame, bytearray(self.pattern_mem[addr:addr+0x10]), x_pos, y_pos, attr)
+            if self.logEnabled: self.log.debug("SPR%d: X: %d Y: %d" % (i/4, x_pos, y_pos))
@@ -1,54 +1,26 @@
 import logging
-import pygame
 import struct
 import time
 
 from pynes import *
 from nesppu import NES_PPU
+from nesapu import NES_APU
+from nesjoypad import NES_Joypad
+from nesops import build_instruction_set
+from nesvideo import FrameQueue, FramePresenter, PygameDisplay
 
 class NESProc:
-    def __init__(self, nes_file, log_level='warning'):
-        
-        # Format: (opcode, length, cycles)
-        # Reference: http://e-tradition.net/bytes/6502/6502_instruction_set.html
-        self.INST_SET = { \
-            '\xA0': (self.do_ldy, 2, 2), '\xA2': (self.do_ldx, 2, 2), \
-            '\x4C': (self.do_jmp, 3, 3), '\x84': (self.do_sty, 2, 3), \
-            '\xA9': (self.do_lda, 2, 2), '\x91': (self.do_sta, 2, 6), \
-            '\x88': (self.do_dey, 1, 2), '\xD0': (self.do_bne, 2, 2), #TODO: conditinal cycles\
-            '\xC0': (self.do_cpy, 2, 2), '\x78': (self.do_sei, 1, 2), \
-            '\xAD': (self.do_lda, 3, 4), '\x10': (self.do_bpl, 2, 2), #TODO: conditional cycles\
-            '\x8D': (self.do_sta, 3, 4), '\x29': (self.do_and, 2, 2), \
-            '\xF0': (self.do_beq, 2, 2), '\x1D': (self.do_ora, 3, 4), #TODO: conditional cycles\
-            '\xD8': (self.do_cld, 1, 2), '\x85': (self.do_sta, 2, 3), \
-            '\x60': (self.do_rts, 1, 6), '\xC6': (self.do_dec, 2, 5), \
-            '\x9A': (self.do_txs, 1, 2), '\x95': (self.do_sta, 2, 4), \
-            '\x9D': (self.do_sta, 3, 5), '\xE8': (self.do_inx, 1, 2), \
-            '\x20': (self.do_jsr, 3, 6), '\x8E': (self.do_stx, 3, 4), \
-            '\xBD': (self.do_lda, 3, 4), '\xE0': (self.do_cpx, 2, 2), #TODO: conditional cycles \
-            '\xB1': (self.do_lda, 2, 5), '\xC8': (self.do_iny, 1, 2), #TODO: conditional cycles \
-            '\xE6': (self.do_inc, 2, 5), '\xCA': (self.do_dex, 1, 2),
-            '\x58': (self.do_cli, 1, 2), '\xA6': (self.do_ldx, 2, 3),
-            '\x86': (self.do_stx, 2, 3), '\xC9': (self.do_cmp, 2, 2),
-            '\x18': (self.do_clc, 1, 2), '\x65': (self.do_adc, 2, 3),
-            '\x40': (self.do_rti, 1, 6), '\x8C': (self.do_sty, 3, 4), \
-            '\xA8': (self.do_tay, 1, 2), '\x99': (self.do_sta, 3, 5), \
-            '\x98': (self.do_tya, 1, 2), '\xEE': (self.do_inc, 3, 6), \
-            '\xEA': (self.do_nop, 1, 2), '\xA5': (self.do_lda, 2, 3), \
-            '\x48': (self.do_pha, 1, 3), '\x8A': (self.do_txa, 1, 2), \
-            '\x0A': (self.do_asl, 1, 2), '\x68': (self.do_pla, 1, 4), \
-            '\xAA': (self.do_tax, 1, 2), '\x6C': (self.do_jmp, 3, 5), \
-            '\x00': (self.do_brk, 1, 7), '\xB0': (self.do_bcs, 2, 2), \
-            '\x2C': (self.do_bit, 3, 4), '\x09': (self.do_ora, 2, 2), \
-            }
-        
+    # video: 'serial' presents each frame inline, 'threaded' hands frames to a
+    # presenter thread (dropping them if it falls behind), 'none' is headless
+    def __init__(self, nes_file, log_level='warning', video='serial'):
         self.cycle_count = 0
+        self.elapsed_cycles = 0     # cycles of all previous frames
         self.A = 0
         self.X = 0
         self.Y = 0
         self.PC = 0x8000
-        self.S = 0xFF
-        self.P = {'C': 0, 'Z': 0, 'I': 0, 'D': 0, 'B': 0, 'V': 0, 'N': 0}
+        self.S = 0xFD
+        self.P = {'C': 0, 'Z': 0, 'I': 1, 'D': 0, 'B': 0, 'V': 0, 'N': 0}
         
         self.irq = 0
         self.reset = 0
@@ -56,6 +28,8 @@ class NESProc:
         
         # PPU info
         self.ppu = NES_PPU(self, log_level)
+        self.apu = NES_APU(self, log_level)
+        self.joypads = [NES_Joypad(self, 0x4016), NES_Joypad(self, 0x4017)]
         
         self.interfaces = { \
             0x2000: ("PPU Control Reg 1", self.ppu.do_ppu_ctrl1_access), \
@@ -67,420 +41,73 @@ class NESProc:
             0x2006: ("PPU Memory Address", self.ppu.do_ppu_addr_access), \
             0x2007: ("PPU Memory Data", self.ppu.do_ppu_data_access), \
             0x4014: ("Sprite Memory DMA", self.ppu.do_ppu_sprite_dma_access), \
-            0x4016: ("Joystick 1", None), }
+            0x4015: ("APU Status", self.apu.do_apu_status_access), \
+            0x4016: ("Joystick 1", self.joypads[0].do_joypad_access), \
+            0x4017: ("APU Frame Counter / Joystick 2", self.do_port2_access), }
+        for addr in range(0x4000, 0x4014):
+            self.interfaces[addr] = ("APU Register", self.apu.register_handler(addr))
         
-        self.log = logging.getLogger("6502-core")
-        self.ch = logging.StreamHandler()
-        self.ch.setLevel(logging.DEBUG)
-        self.log.addHandler(self.ch)
-        self.log.setLevel(LEVELS[log_level])
+        self.log = get_logger("6502-core", log_level)
         self.loglevel = LEVELS[log_level]
         self.logEnabled = True
         
         self.vblank = False
+        self.frame_count = 0
+        self.last_frame = None
+        self.frame_time = time.time()
         self.nes_file = nes_file
         self.memory = bytearray(0x10000)  #64kb of main RAM
-        if len(self.nes_file.prgs) == 1:
-            self.write_memory(0x8000, self.nes_file.prgs[0]) #TODO: make better
-            self.write_memory(0xC000, self.nes_file.prgs[0])
-        elif len(self.nes_file.prgs) > 1:
-            self.write_memory(0x8000, self.nes_file.prgs[0])
-            self.write_memory(0xC000, self.nes_file.prgs[1])
+        # PRG-ROM is read straight out of the ROM file's banks rather than
+        # copied into memory; these are the banks at $8000 and $C000
+        if len(self.nes_file.prg_windows) == 2:
+            self.prg_banks = self.nes_file.prg_windows
         else:
             print "invalid length of PRG-ROM"
+            self.prg_banks = [bytearray(0x4000), bytearray(0x4000)]
+        if self.nes_file.chr_count:
+            self.ppu.pattern_mem = self.nes_file.chrs[0]
         
-        pygame.init()
-        self.window = pygame.display.set_mode((256,240))
-    
-    def do_ldx(self, data):
-        if data[0] == '\xA2':
-            val = ord(data[1])
-            if self.logEnabled: self.log.debug("LDX $%02x" % val)
-            self.X = val
-            self.set_flags(self.X)
-        elif data[0] == '\xA6':
-            addr = ord(data[1])
-            val = ord(self.read_memory(addr, 1))
-            if self.logEnabled: self.log.debug("LDX [$%02x]" % addr)
-            self.X = val
-            self.set_flags(self.X)
-    
-    def do_ldy(self, data):
-        addr = ord(data[1])
-        if self.logEnabled: self.log.debug("LDY $%02x" % addr)
-        self.Y = addr
-        self.set_flags(self.Y)
-    
-    def do_lda(self, data):
-        if data[0] == '\xA9':
-            val = ord(data[1])
-            if self.logEnabled: self.log.debug("LDA %02x" % val)
-        elif data[0] == '\xAD':
-            addr = struct.unpack('H', data[1:3])[0]
-            val = ord(self.read_memory(addr, 1))
-            if self.logEnabled: self.log.debug("LDA [$%04x] => $%02x" % (addr, val))
-        elif data[0] == '\xBD':
-            abs_addr = struct.unpack('H', data[1:3])[0]
-            addr = abs_addr + self.X
-            val = ord(self.read_memory(addr, 1))
-            if self.logEnabled: self.log.debug("LDA [$%04x, X], X = $%02x => $%02x" % (abs_addr, self.X, val))
-        elif data[0] == '\xB1':
-            addr = ord(data[1]) + self.Y
-            val = ord(self.read_memory(addr, 1))
-            if self.logEnabled: self.log.debug("LDA [$%02x + Y], Y = $%02x => $%02x" % (addr, self.Y, val))
-        elif data[0] == '\xA5':
-            addr = ord(data[1])
-            val = ord(self.read_memory(addr, 1))
-            if self.logEnabled: self.log.debug("LDA [$%04x] => $%02x" % (addr, val))
-        
-        self.A = val & 0xFF
-        self.set_flags(self.A)
-    
-    def do_sty(self, data):
-        if data[0] == '\x84':
-            addr = ord(data[1])
-            if self.logEnabled: self.log.debug("STY $%02x" % addr)
-        elif data[0] == '\x8C':
-            addr = struct.unpack('H', data[1:3])[0]
-            if self.logEnabled: self.log.debug("STY $%04x" % addr)
-        else:
-            self.log.error("Unknown STY opcode")
-            return
-        self.write_memory(addr, chr(self.Y))
-    
-    def do_sta(self, data):
-        if data[0] == '\x91':
-            #TODO: Don't think this is fully complete
-            addr = ord(data[1])
-            if self.logEnabled: self.log.debug("STA $%02x" % addr)
-        elif data[0] == '\x8D':
-            addr = struct.unpack('H', data[1:3])[0]
-            if self.logEnabled: self.log.debug("STA $%04x" % addr)
-        elif data[0] == '\x85':
-            addr = ord(data[1])
-            if self.logEnabled: self.log.debug("STA $%02x" % addr)
-        elif data[0] == '\x95':
-            addr = ord(data[1]) + self.X
-            if self.logEnabled: self.log.debug("STA $%02x, X, X = $%02x" % (ord(data[1]), self.X))
-        elif data[0] == '\x9D':
-            abs_addr = struct.unpack('H', data[1:3])[0]
-            addr = abs_addr + self.X
-            if self.logEnabled: self.log.debug("STA $%04x, X, X = $%02x" % (abs_addr, self.X))
-        elif data[0] == '\x99':
-            abs_addr = struct.unpack('H', data[1:3])[0]
-            addr = abs_addr + self.Y
-            if self.logEnabled: self.log.debug("STA $%04x, Y, Y = $%02x" % (abs_addr, self.Y))
-        else:
-            self.log.error("Unknown STA opcode!")
-            return
-        self.write_memory(addr, chr(self.A))
-    
-    def do_jmp(self, data):
-        if data[0] == '\x4C':
-            loc = struct.unpack('H', data[1:3])[0]
-        elif data[0] == '\x6C':
-            addr = struct.unpack('H', data[1:3])[0]
-            loc = struct.unpack('H', self.read_memory(addr, 2))[0]
-        else:
-            self.log.error('Unknown JMP opcode')
-            return
-        if self.logEnabled: self.log.debug("JMP $%04x" % loc)
-        return loc
-    
-    def do_dey(self, data):
-        if self.logEnabled: self.log.debug("DEY")
-        if self.Y == 0:
-            self.Y = 0xFF
-        else:
-            self.Y -= 1
-        self.set_flags(self.Y)
-    
-    def calc_rel_jmp(self, data):
-        return self.PC + struct.unpack('b',data[1])[0] + self.INST_SET[data[0]][1]
-    
-    def do_bne(self, data):
-        offset = self.calc_rel_jmp(data)
-        if self.logEnabled: self.log.debug("BNE $%04x + $%02x => $%04x" % (self.PC, struct.unpack('b',data[1])[0], offset))
-        if self.P['Z'] == 0:
-            return offset
-    
-    def do_cpy(self, data):
-        addr = ord(data[1])
-        temp = self.Y - self.memory[addr]
-        if temp == 0:
-            self.P['Z'] = 1
-        else:
-            self.P['Z'] = 0
-        
-        if temp > 0x7F:
-            self.P['N'] = 1
-        else:
-            self.P['N'] = 0
-        
-        if self.Y >= addr:
-            self.P['C'] = 1
-        else:
-            self.P['C'] = 0
-        
-        if self.logEnabled: self.log.debug("CPY $%02x" % addr)
-    
-    def do_sei(self, data):
-        if self.logEnabled: self.log.debug("SEI")
-        self.P['I'] = 1
-    
-    def do_bpl(self, data):
-        offset = self.calc_rel_jmp(data)
-        if self.logEnabled: self.log.debug("BPL $%04x + $%02x => $%04x" % (self.PC, struct.unpack('b',data[1])[0], offset))
-        if self.P['N'] == 0:
-            return offset
-    
-    def do_and(self, data):
-        addr = ord(data[1])
-        if self.logEnabled: self.log.debug("AND $%02x" % addr)
-        self.A &= addr
-        self.set_flags(self.A)
-    
-    def do_beq(self, data):
-        offset = self.calc_rel_jmp(data)
-        if self.logEnabled: self.log.debug("BEQ $%04x + $%02x => $%04x" % (self.PC, struct.unpack('b',data[1])[0], offset))
-        if self.P['Z'] == 1:
-            return offset
-    
-    def do_ora(self, data):
-        if data[0] == '\x1d':
-            addr = struct.unpack('H', data[1:3])[0]
-            val = ord(self.read_memory(addr, 1))
-            if self.logEnabled: self.log.debug("ORA $%02x, X" % val)
-        elif data[0] == '\x09':
-            val = ord(data[1])
-            if self.logEnabled: self.log.debug("ORA $%02x, X" % val)
-        else:
-            raise PyNESException('Unknown ORA opcode')
-        self.A = (self.X | val) & 0xFF
-        self.set_flags(self.A)
-    
-    def do_cld(self, data):
-        if self.logEnabled: self.log.debug("CLD")
-        self.P['D'] = 0
-    
-    def do_rts(self, data):
-        new_loc = self.pop_stack()
-        if self.logEnabled: self.log.debug("RTS => $%04x" % new_loc)
-        return new_loc
-    
-    def set_flags(self, val):
-        if val == 0:
-            self.P['Z'] = 1
-        else:
-            self.P['Z'] = 0
-        if val & 0x80:
-            self.P['N'] = 1
-        else:
-            self.P['N'] = 0
-    
-    def do_dec(self, data):
-        if data[0] == "\xC6":
-            addr = ord(data[1])
-            if self.logEnabled: self.log.debug("DEC $%02x" % addr)
-            temp = ord(self.read_memory(addr, 1))
-            if temp == 0:
-                temp = 0xFF
-            else:
-                temp -= 1
-            self.write_memory(addr, chr(temp))
-            self.set_flags(temp)
-    
-    def do_txs(self, data):
-        self.S = self.X
-        if self.logEnabled: self.log.debug("TXS")
-        self.set_flags(self.S)
-    
-    def do_inx(self, data):
-        self.X += 1
-        if self.logEnabled: self.log.debug("INX")
-        if self.X == 0x100:
-            self.X = 0
-        self.set_flags(self.X)
-    
-    def do_iny(self, data):
-        self.Y += 1
-        if self.logEnabled: self.log.debug("INY")
-        if self.Y == 0x100:
-            self.Y = 0
-        self.set_flags(self.Y)
-    
-    def do_jsr(self, data):
-        self.push_stack(self.PC + 3)
-        new_loc = struct.unpack('H', data[1:3])[0]
-        if self.logEnabled: self.log.debug("JSR $%04x" % new_loc)
-        return new_loc
-    
-    def do_stx(self, data):
-        if data[0] == '\x8E':
-            addr = struct.unpack(    'H', data[1:3])[0]
-            if self.logEnabled: self.log.debug("STX $%04x" % addr)
-            self.write_memory(addr, chr(self.X))
-        if data[0] == '\x86':
-            addr = ord(data[1])
-            if self.logEnabled: self.log.debug("STX $%02x" % addr)
-            self.write_memory(addr, chr(self.X))
-    
-    def do_cpx(self, data):
-        if data[0] == '\xE0':
-            operand = ord(data[1])
-            result = self.X - operand
-            if result < 0:
-                result = 256 + result #emulate 8-bit register
-            self.set_flags(result)
-            if self.X >= operand:
-                self.C = 1
-            else:
-                self.C = 0
-    
-    def do_inc(self, data):
-        if data[0] == '\xE6':
-            addr = ord(data[1])
-            if self.logEnabled: self.log.debug("INC $%02x" % addr)
-        elif data[0] == '\xEE':
-            addr = struct.unpack('H', data[1:3])[0]
-            if self.logEnabled: self.log.debug("INC $%04x" % addr)
-        else:
-            self.log.error("Unknown INC opcode")
-        
-        val = ord(self.read_memory(addr, 1))
-        val += 1
-        if val == 0x100:
-            val = 0
-        self.write_memory(addr, chr(val))
-        self.set_flags(val)
-    
-    def do_dex(self, data):
-        self.X -= 1
-        self.set_flags(self.X)
-        if self.logEnabled: self.log.debug("DEX")
-    
-    def do_cli(self, data):
-        self.P['I'] = 0
-        if self.logEnabled: self.log.debug("CLI")
-    
-    def do_cmp(self, data):
-        val = ord(data[1])
-        result = (self.A - val) & 0xFF
-        if self.A >= val:
-            self.P['C'] = 1
-        else:
-            self.P['C'] = 0
-        self.set_flags(self.A)
-        if self.logEnabled: self.log.debug("CMP $%02x" % val)
-    
-    def do_clc(self, data):
-        self.P['C'] = 0
-        if self.logEnabled: self.log.debug("CLC")
-    
-    def do_adc(self, data):
-        if data[0] == '\x65':
-            addr = ord(data[1])
-            val = ord(self.read_memory(addr, 1)[0])
-            if self.logEnabled: self.log.debug("ADC $%02x" % addr)
-        
-        result = (self.A + val + self.P['C']) & 0xFF
-        #if (result & 0x80) != (self.A & 80):
-        #ref: http://nesdev.parodius.com/bbs/viewtopic.php?t=6331&sid=c635c096178295cde45bd5e7ba0d2ca5
-        if (self.A ^ result) & (val ^ result) & 0x80:
-            self.P['V'] = 1
+        self.frames = FrameQueue()
+        self.frame_sinks = []
+        self.display = None
+        self.presenter = None
+        if video == 'threaded':
+            self.display = PygameDisplay(self.ppu.palette)
+            self.presenter = FramePresenter(self.frames, self.display)
+        elif video == 'serial':
+            self.display = PygameDisplay(self.ppu.palette)
+            self.display.open()
+        elif video != 'none':
+            raise PyNESException("Unknown video mode: %s" % video)
+    
+    # Writes to $4017 go to the APU frame counter, reads come from joystick 2
+    def do_port2_access(self, is_write, val):
+        if is_write:
+            self.apu.do_apu_frame_counter_access(is_write, val)
         else:
-            self.P['V'] = 0
-        
-        if result > 0xFF:
-            self.P['C'] = 1
-            result = 0xFF - result
-        else:
-            self.P['C'] = 0
-        
-        self.A = result & 0xFF
-    
-    def do_rti(self, data):
-        if self.logEnabled: self.log.debug("RTI")
-        self.set_flags(self.pop_stack())
-        return self.pop_stack()
-    
-    def do_tay(self, data):
-        if self.logEnabled: self.log.debug("TAY")
-        self.Y = self.A
-        self.set_flags(self.Y)
-    
-    def do_tax(self, data):
-        if self.logEnabled: self.log.debug("TAX")
-        self.X = self.A
-        self.set_flags(self.X)
-    
-    def do_tya(self, data):
-        if self.logEnabled: self.log.debug("TYA")
-        self.A = self.Y
-        self.set_flags(self.A)
-    
-    def do_nop(self, data):
-        if self.logEnabled: self.log.debug("NOP")
-    
-    def do_pha(self, data):
-        self.push_stack(self.A)
-        if self.logEnabled: self.log.debug("PHA    ")
-    
-    def do_txa(self, data):
-        if self.logEnabled: self.log.debug("TXA")
-        self.A = self.X
-        self.set_flags(self.A)
-    
-    def do_asl(self, data):
-        if data[0] == '\x0A':
-            self.P['C'] = self.A & 0x80
-            self.A = (self.A * 2) & 0xFF
-            self.set_flags(self.A)
-            if self.logEnabled: self.log.debug("ASL A")
-        else:
-            self.log.error("Unknown ASL opcode")
-            return
-    
-    def do_pla(self, data):
-        self.A = self.pop_stack() & 0xFF
-        self.set_flags(self.A)
-        if self.logEnabled: self.log.debug("PLA")
-    
-    def do_brk(self, data):
-        self.push_stack(self.PC)
-        self.push_stack(self.get_all_flags())
-        self.P['B'] = 1
-        return self.irq
-    
-    def do_bcs(self, data):
-        if self.logEnabled: self.log.debug("BCS")
-        if self.P['C']:
-            addr = ord(data[1])
-            if addr > 127: addr = 127 - addr
-            return self.PC + addr
-    
-    def do_bit(self, data):
-        if data[0] == '\x2C':
-            addr = struct.unpack('H', data[1:3])[0]
-            val = ord(self.read_memory(addr, 1))
-        else:
-            self.log.error("Unknown BIT opcode")
-            return
-        if self.logEnabled: self.log.debug("BIT 0x%02x & 0x%02x" % (self.A, val))
-        result = self.A & val
-        if result == 0:
-            self.P['Z'] = 1
-        else:
-            self.P['Z'] = 0
-        if val & 0x40:
-            self.P['V'] = 1
-        else:
-            self.P['V'] = 0
-        if val & 0x80:
-            self.P['N'] = 1
-        else:
-            self.P['N'] = 0
-    
+            self.joypads[1].read()
+    
+    # Snapshot of the whole machine as plain Python data (strings, numbers,
+    # tuples, lists and dicts), suitable for marshal. PRG-ROM is not included.
+    def save_state(self):
+        return {'cpu': (self.A, self.X, self.Y, self.PC, self.S, dict(self.P), \
+                        self.cycle_count, self.elapsed_cycles, self.vblank, self.frame_count),
+                'vectors': (self.irq, self.reset, self.nmi),
+                'memory': str(self.memory[:0x8000]),
+                'ppu': self.ppu.save_state(),
+                'apu': self.apu.save_state(),
+                'joypads': [(j.buttons, j.strobe, j.index) for j in self.joypads]}
+    
+    def load_state(self, state):
+        (self.A, self.X, self.Y, self.PC, self.S, P, \
+         self.cycle_count, self.elapsed_cycles, self.vblank, self.frame_count) = state['cpu']
+        self.P = dict(P)
+        (self.irq, self.reset, self.nmi) = state['vectors']
+        self.memory[:0x8000] = state['memory']
+        self.ppu.load_state(state['ppu'])
+        self.apu.load_state(state['apu'])
+        for joypad, (buttons, strobe, index) in zip(self.joypads, state['joypads']):
+            (joypad.buttons, joypad.strobe, joypad.index) = (buttons, strobe, index)
     
     #internal func
     def do_write_ram(self, addr, val):
@@ -490,43 +117,52 @@ class NESProc:
         '''for i in range(len(val)):
             self.memory[addr+i] = ord(val[i])'''
     
+    # P in the layout the 6502 pushes it: NV1BDIZC. B only exists on the
+    # stack, so it comes from the flags dict only if someone set it there.
     def get_all_flags(self):
-        return self.P['C'] | self.P['Z'] << 1 | self.P['I'] << 2 | \
-            self.P['D'] << 3 | self.P['B'] << 4 | self.P['V'] << 5 | \
-            self.P['N'] << 6
+        P = self.P
+        return P['C'] | P['Z'] << 1 | P['I'] << 2 | P['D'] << 3 | \
+            P['B'] << 4 | 0x20 | P['V'] << 6 | P['N'] << 7
     
+    # Bits 4 and 5 of a pulled status byte are ignored
     def set_all_flags(self, value):
-        self.P['C'] = value & 1
-        self.P['Z'] = value & 2
-        self.P['I'] = value & 4
-        self.P['D'] = value & 8
-        self.P['B'] = value & 16
-        self.P['V'] = value & 32
-        self.P['N'] = value & 64
+        P = self.P
+        P['C'] = value & 1
+        P['Z'] = (value >> 1) & 1
+        P['I'] = (value >> 2) & 1
+        P['D'] = (value >> 3) & 1
+        P['V'] = (value >> 6) & 1
+        P['N'] = value >> 7
     
     def stack_dump(self):
         if self.logEnabled: self.log.debug("Stack Dump")
-        cur_addr = 0xFF
         output = ''
-        while cur_addr >= self.S:
-            output += "$%04x: $%04x\n" % (0x0100+cur_addr, struct.unpack('H', self.read_memory(0x0100 + cur_addr, 2))[0])
-            cur_addr -= 2
+        for addr in range(0x01FF, 0x0100 + self.S, -1):
+            output += "$%04x: $%02x\n" % (addr, self.memory[addr])
         if self.logEnabled: self.log.debug(output)
     
     def push_stack(self, value):
         # Reference: http://www.obelisk.demon.co.uk/6502/registers.html
         # Points to lower 8-bits of stack address (0x0100 -> 0x0x01FF)
         # Points to next free stack location
-        self.S -= 2
-        self.write_memory(0x0100 + self.S, struct.pack('H', value))
-        if self.logEnabled: self.log.debug("Pushing $%04x" % value)
-        self.stack_dump()
+        self.write_memory(0x0100 + self.S, chr(value & 0xFF))
+        self.S = (self.S - 1) & 0xFF
+        if self.loglevel <= logging.DEBUG:
+            self.log.debug("Pushing $%02x" % value)
+            self.stack_dump()
     
     def pop_stack(self):
-        self.stack_dump()
-        stack_val = self.read_memory(0x0100 + self.S, 2)
-        self.S += 2
-        return struct.unpack('H', stack_val)[0]
+        self.S = (self.S + 1) & 0xFF
+        return ord(self.read_memory(0x0100 + self.S, 1))
+    
+    # 16 bit values go high byte first, so they sit little endian in memory
+    def push_word(self, value):
+        self.push_stack(value >> 8)
+        self.push_stack(value)
+    
+    def pop_word(self):
+        lo = self.pop_stack()
+        return lo | self.pop_stack() << 8
     
     # val = string of data to write
     def write_memory(self, addr, val):
@@ -560,6 +196,8 @@ class NESProc:
     
     # returns a data string copy of the memory
     def read_memory(self, addr, length):
+        if addr >= 0x8000:
+            return self.read_prg(addr, length)
         if self.interfaces.has_key(addr):
             if self.logEnabled: self.log.info("Reading from %s" % self.interfaces[addr][0])
             if self.interfaces[addr][1]:
@@ -567,71 +205,46 @@ class NESProc:
         
         return str(self.memory[addr:addr+length])
     
-    def render_sprite(self, data, coord, attr):
-        s = pygame.Surface([8,8])
-        for y in range(8):
-            low_byte = data[y]
-            high_byte = data[8+y]
-            for x in range(8):
-                if not (low_byte & x) and not (high_byte & x):
-                    color_sel = 0
-                elif low_byte & x and not (high_byte & x):
-                    color_sel = 1
-                elif not (low_byte & x) and high_byte & x:
-                    color_sel = 2
-                else:
-                    color_sel = 3
-                color_sel |= (attr & 0x3) << 2
-                #print "%d,%d = %d" % (x,y,color_sel | (attr & 0x3) << 2)
-                #print "0x%02x " % self.vram[0x3f00+color_sel],
-                s.set_at((x,y), self.ppu.palette[self.ppu.vram[0x3f00+color_sel]])
-            #print ""
-        
-        return s
+    def read_prg(self, addr, length):
+        offset = addr & 0x3FFF
+        data = self.prg_banks[(addr >> 14) & 1][offset:offset+length]
+        if offset + length > 0x4000 and addr < 0xC000:
+            # Crossing from the $8000 bank into the $C000 bank
+            data += self.read_prg(0xC000, offset + length - 0x4000)
+        return str(data)
+    
+    # Like read_memory, but without triggering memory mapped interfaces
+    def peek_memory(self, addr, length):
+        if addr >= 0x8000:
+            return self.read_prg(addr, length)
+        return str(self.memory[addr:addr+length])
     
     def update_screen(self):
-        self.window.fill((0,0,0))
-        #for byte in self.vram[0x3f00:0x3f10]:
-        #    print byte
-        for i in range(0, 256, 4):
-            (y_pos, pat_num, attr, x_pos) = struct.unpack("BBBB", str(self.ppu.spr_ram[i:i+4]))
-            if pat_num:
-                #print "Sprite %d: Pattern #%d" % (i/4, pat_num)
-                #print "Pattern table @ 0x%04x" % self.PPU_pattern_table
-                sprite = self.render_sprite(self.memory[self.ppu.PPU_pattern_table+pat_num*0x10:self.ppu.PPU_pattern_table+pat_num*0x10+0x10], (x_pos, y_pos), attr)
-                
-                self.ppu.sprites[i/4] = sprite
-            else:
-                continue
-            
-            self.window.blit(self.ppu.sprites[i/4], (x_pos,y_pos))
-            if self.logEnabled: self.log.debug("SPR%d: X: %d Y: %d" % (i/4, x_pos, y_pos))
-        #print self.sprites
-        pygame.display.update()
+        frame = self.frames.back
+        self.ppu.render_frame(frame)
+        self.frame_count += 1
+        self.last_frame = frame
+        for sink in self.frame_sinks:
+            sink.write_frame(frame)
+        if self.presenter:
+            self.frames.submit()
+        elif self.display:
+            self.display.present(frame)
     
     def parse_instruction(self, data):
-        #print "Parsing: %02x" % ord(data[0])
-        new_loc = None
-        if self.INST_SET.has_key(data[0]):
-            new_loc = self.INST_SET[data[0]][0](data)
-        else:
-            if self.logEnabled: self.log.error("Unknown Opcode:")
+        inst = self.INST_SET.get(data[0])
+        if inst is None:
             output = ''
             for i in range(10):
-                output += "%02x " % ord(self.read_memory(self.PC+i, 1))
-                #print "%02x " % ord(char),
-            if self.logEnabled: self.log.error(output)
-            
-            sys.exit()
-            #print "Unknown Opcode - skipping"
-            #new_loc = self.PC + 1
+                output += "%02x " % ord(self.peek_memory((self.PC + i) & 0xFFFF, 1))
+            if self.logEnabled: self.log.error("Unknown Opcode: %s" % output)
+            raise PyNESException("Unknown opcode $%02x at $%04x" % (ord(data[0]), self.PC))
         
-        # Increment PC
-        if new_loc:
-            self.PC = new_loc
+        new_loc = inst[0](self, data)
+        if new_loc is None:
+            self.PC = (self.PC + inst[1]) & 0xFFFF
         else:
-            self.PC += self.INST_SET[data[:1]][1]
-        #print "PC = $%04x" % self.PC
+            self.PC = new_loc
     
     def print_regs(self):
         if self.logEnabled: self.log.debug("A: $%02x, X: $%02x, Y: $%02x, S: $%04x, PC: $%04x, Cycles: %d" % \
@@ -640,54 +253,109 @@ class NESProc:
             (self.P['N'], self.P['V'], self.P['B'], self.P['D'], \
             self.P['I'], self.P['Z'], self.P['C']))
     
-    def run(self):
+    # CPU cycles since power on
+    def total_cycles(self):
+        return self.elapsed_cycles + self.cycle_count
+    
+    def load_vectors(self):
         self.nmi = struct.unpack('H', self.read_memory(0xFFFA, 2))[0]
         self.irq = struct.unpack('H', self.read_memory(0xFFFE, 2))[0]
         self.reset = struct.unpack('H', self.read_memory(0xFFFC, 2))[0]
         if self.logEnabled: self.log.info("Reset $%04x" % self.reset)
         if self.logEnabled: self.log.info("NMI $%04x" % self.nmi)
         if self.logEnabled: self.log.info("IRQ $%04x" % self.irq)
+        self.PC = self.reset
+    
+    # debugger: an NESDebugger to drive execution instead of the plain loop
+    def run(self, debugger=None):
+        self.load_vectors()
         
-        old_time = time.time()
+        if self.presenter:
+            self.presenter.start()
+        try:
+            if debugger:
+                debugger.run()
+            else:
+                self.run_loop()
+        finally:
+            for sink in self.frame_sinks:
+                sink.close()
+            self.apu.close()
+            if self.presenter:
+                self.presenter.stop()
+                if self.logEnabled: self.log.info("Frames presented: %d, dropped: %d" % \
+                    (self.frames.submitted, self.frames.dropped))
+    
+    def run_loop(self):
+        step = self.step
         while True:
-            #offset = self.PC - 0x8000
-            
-            #for char in self.nes_file.prgs[0][offset:offset+10]:
-            if self.loglevel <= logging.DEBUG:
-                output = ''
-                for i in range(10):
-                    output += "%02x " % ord(self.read_memory(self.PC+i, 1))
-                    #print "%02x " % ord(char),
-                if self.logEnabled: self.log.debug(output)
-            
-            if self.loglevel <= logging.DEBUG:
-                self.print_regs()
-            #data = self.nes_file.prgs[0][offset:offset+5]
-            data = self.read_memory(self.PC, 5)
-            self.parse_instruction(data)
-            
-            # VBlank emulation
-            self.cycle_count += self.INST_SET[data[:1]][2]
-            if self.cycle_count >= 29760 and self.vblank == False:
-                print "Time delta: %f" % (time.time() - old_time)
-                old_time = time.time()
-                ppu_status = ord(self.read_memory(0x2002, 1))
-                if self.logEnabled: self.log.info("VBlank ON: PPU Status: 0x%02x" % ppu_status)
-                self.write_memory(0x2002, chr(ppu_status | 0x80))
-                self.cycle_count = 0
-                self.vblank = True
-                
-                if self.P['I'] == 0 and self.ppu.PPU_vblank_enable:
-                    self.push_stack(self.PC)
-                    self.push_stack(self.get_all_flags())
-                    self.PC = self.nmi
+            step()
+    
+    # Run until 'count' more frames have been rendered
+    def run_frames(self, count):
+        target = self.frame_count + count
+        step = self.step
+        while self.frame_count < target:
+            step()
+    
+    # Opcode fetches bypass the memory mapped interfaces of read_memory
+    def fetch_instruction(self):
+        if self.PC >= 0x8000:
+            return self.read_prg(self.PC, 5)
+        return str(self.memory[self.PC:self.PC+5])
+    
+    # Execute a single instruction, including VBlank emulation
+    def step(self):
+        #offset = self.PC - 0x8000
+        
+        #for char in self.nes_file.prgs[0][offset:offset+10]:
+        if self.loglevel <= logging.DEBUG:
+            # peek, so the preview neither triggers interfaces nor counts as
+            # a data read for wrappers such as the code/data logger
+            output = ''
+            for i in range(10):
+                output += "%02x " % ord(self.peek_memory((self.PC + i) & 0xFFFF, 1))
+                #print "%02x " % ord(char),
+            if self.logEnabled: self.log.debug(output)
+        
+        if self.loglevel <= logging.DEBUG:
+            self.print_regs()
+        #data = self.nes_file.prgs[0][offset:offset+5]
+        data = self.fetch_instruction()
+        self.parse_instruction(data)
+        
+        # VBlank emulation
+        self.cycle_count += self.INST_SET[data[:1]][2]
+        if self.cycle_count >= 29760 and self.vblank == False:
+            print "Time delta: %f" % (time.time() - self.frame_time)
+            self.frame_time = time.time()
+            ppu_status = ord(self.read_memory(0x2002, 1))
+            if self.logEnabled: self.log.info("VBlank ON: PPU Status: 0x%02x" % ppu_status)
+            self.write_memory(0x2002, chr(ppu_status | 0x80))
+            self.apu.end_frame(self.cycle_count)
+            self.elapsed_cycles += self.cycle_count
+            self.cycle_count = 0
+            self.vblank = True
             
-            #TODO: how long does a VBlank last?
-            #if self.cycle_count >= 59520 and self.vblank == True:
-            #ref: http://wiki.nesdev.com/w/index.php/Clock_rate
-            if self.cycle_count >= 2728 and self.vblank == True:
-                self.update_screen()
-                ppu_status = ord(self.read_memory(0x2002, 1))
-                if self.logEnabled: self.log.info("VBlank OFF: PPU Status: 0x%02x" % ppu_status)
-                self.write_memory(0x2002, chr(ppu_status & 0x7F))
-                self.vblank = False
\ No newline at end of file
+            # NMI can't be masked by the I flag
+            if self.ppu.PPU_vblank_enable:
+                self.push_word(self.PC)
+                self.push_stack(self.get_all_flags())
+                self.P['I'] = 1
+                self.PC = self.nmi
+                self.cycle_count += 7
+        
+        #TODO: how long does a VBlank last?
+        #if self.cycle_count >= 59520 and self.vblank == True:
+        #ref: http://wiki.nesdev.com/w/index.php/Clock_rate
+        if self.cycle_count >= 2728 and self.vblank == True:
+            self.update_screen()
+            ppu_status = ord(self.read_memory(0x2002, 1))
+            if self.logEnabled: self.log.info("VBlank OFF: PPU Status: 0x%02x" % ppu_status)
+            self.write_memory(0x2002, chr(ppu_status & 0x7F))
+            self.vblank = False
+    
+    # Format: (handler, length, cycles, mnemonic, addressing mode)
+    # Built once at import from the opcode table in nesops; handlers are plain
+    # functions called as handler(self, data)
+    INST_SET = build_instruction_set()
@@ -0,0 +1,302 @@
+import base64
+import json
+import marshal
+import multiprocessing
+import os
+import SocketServer
+import stat
+import sys
+import threading
+
+from pynes import *
+from nesfile import NESFile
+from nesproc import NESProc
+from nesvideo import FRAME_WIDTH, FRAME_HEIGHT, rgb_table, frame_to_rgb
+
+# States travel as marshal data rather than pickles, so a state sent by a
+# client can't run code in the worker.
+#
+# Line based JSON protocol. Every request is one JSON object per line with a
+# "cmd" field; every reply is one line, {"ok": true, ...} or
+# {"ok": false, "error": "..."}. Binary data (memory, frames, states) is
+# base64 encoded.
+#
+#   {"cmd": "load", "rom": PATH}                      -> {"instance": ID}
+#   {"cmd": "close", "instance": ID}
+#   {"cmd": "list"}                                   -> {"instances": [...]}
+#   {"cmd": "step", "instance": ID, "frames": N}      -> {"frame_count": N}
+#   {"cmd": "input", "instance": ID, "port": 1|2, "buttons": MASK or ["A", ...]}
+#   {"cmd": "read", "instance": ID, "addr": A, "length": N} -> {"data": B64}
+#   {"cmd": "write", "instance": ID, "addr": A, "data": B64}
+#   {"cmd": "frame", "instance": ID, "format": "indexed"|"rgb"}
+#                                     -> {"data": B64, "width": W, "height": H}
+#   {"cmd": "save_state", "instance": ID}             -> {"state": B64}
+#   {"cmd": "load_state", "instance": ID, "state": B64}
+
+NUMBER_TYPES = (int, long, float, bool, type(None))
+
+# Upper bound for one step request (about half an hour of NTSC frames), so a
+# single request can't tie up an instance indefinitely
+MAX_STEP_FRAMES = 100000
+
+# Client states must have exactly the shape of the instance's own
+# save_state(): the same dict keys, tuple lengths and string sizes, and
+# numbers where it has numbers. load_state can then neither add attributes
+# nor resize memory. Lists may differ in length (e.g. pending APU writes).
+def check_state(expected, state, path='state'):
+    if isinstance(expected, NUMBER_TYPES):
+        valid = isinstance(state, NUMBER_TYPES)
+    elif isinstance(expected, str):
+        valid = isinstance(state, str) and len(state) == len(expected)
+    elif isinstance(expected, dict):
+        valid = isinstance(state, dict) and sorted(state.keys()) == sorted(expected.keys())
+        if valid:
+            for key in expected:
+                check_state(expected[key], state[key], "%s.%s" % (path, key))
+    elif isinstance(expected, tuple):
+        valid = isinstance(state, tuple) and len(state) == len(expected)
+        if valid:
+            for i, (e, v) in enumerate(zip(expected, state)):
+                check_state(e, v, "%s[%d]" % (path, i))
+    elif isinstance(expected, list):
+        valid = isinstance(state, list)
+        if valid:
+            for i, v in enumerate(state):
+                if expected:
+                    check_state(expected[min(i, len(expected) - 1)], v, "%s[%d]" % (path, i))
+                elif not isinstance(v, tuple) or \
+                        not all([isinstance(n, NUMBER_TYPES) for n in v]):
+                    valid = False
+    else:
+        valid = False
+    if not valid:
+        raise PyNESException("Invalid state: %s" % path)
+
+class EmulatorWorker:
+    # Runs one NESProc in its own process. Emulation happens there, so a long
+    # "step" only ties up the connection that asked for it.
+    def __init__(self, rom, log_level):
+        self.rom = rom
+        (self.conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_main,
+            args=(child_conn, rom, log_level))
+        self.process.daemon = True
+        self.process.start()
+        # Only the worker keeps its end open, so its exit shows up as EOF here
+        child_conn.close()
+        self.lock = threading.Lock()
+        # The worker reports whether the ROM loaded before taking commands
+        try:
+            self.reply()
+        except PyNESException:
+            self.process.join(1)
+            raise
+    
+    def reply(self):
+        try:
+            (ok, result) = self.conn.recv()
+        except (EOFError, IOError):
+            raise PyNESException("Emulator process for %s exited" % self.rom)
+        if not ok:
+            raise PyNESException(result)
+        return result
+    
+    def call(self, name, *args):
+        self.lock.acquire()
+        try:
+            try:
+                self.conn.send((name, args))
+            except IOError:
+                raise PyNESException("Emulator process for %s exited" % self.rom)
+            return self.reply()
+        finally:
+            self.lock.release()
+    
+    def close(self):
+        try:
+            self.call('quit')
+        except PyNESException:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+def worker_main(conn, rom, log_level):
+    # Per frame timing output would only clutter the server's console
+    sys.stdout = open(os.devnull, 'w')
+    nes_file = NESFile(rom)
+    if not nes_file.parse():
+        conn.send((False, "Unable to load ROM: %s" % rom))
+        return
+    proc = NESProc(nes_file, log_level, 'none')
+    proc.load_vectors()
+    rgb = rgb_table(proc.ppu.palette)
+    conn.send((True, None))
+    
+    while True:
+        try:
+            (name, args) = conn.recv()
+        except EOFError:
+            return
+        try:
+            if name == 'quit':
+                conn.send((True, None))
+                return
+            elif name == 'step':
+                proc.run_frames(args[0])
+                result = proc.frame_count
+            elif name == 'input':
+                proc.joypads[args[0] - 1].set_buttons(args[1])
+                result = None
+            elif name == 'read':
+                result = proc.peek_memory(args[0], args[1])
+            elif name == 'write':
+                proc.write_memory(args[0], args[1])
+                result = None
+            elif name == 'frame':
+                frame = proc.last_frame or proc.frames.back
+                if args[0] == 'rgb':
+                    result = frame_to_rgb(frame, rgb)
+                else:
+                    result = str(frame)
+            elif name == 'save_state':
+                result = marshal.dumps(proc.save_state())
+            elif name == 'load_state':
+                state = marshal.loads(args[0])
+                check_state(proc.save_state(), state)
+                proc.load_state(state)
+                result = None
+            else:
+                raise PyNESException("Unknown worker command: %s" % name)
+            conn.send((True, result))
+        except Exception, e:
+            conn.send((False, "%s: %s" % (e.__class__.__name__, e)))
+
+def check_range(addr, length):
+    if addr < 0 or length < 0 or addr + length > 0x10000:
+        raise PyNESException("Address range out of bounds: addr %d, length %d" % (addr, length))
+
+def check_value(name, value, low, high):
+    if value < low or value > high:
+        raise PyNESException("%s must be between %d and %d, not %d" % (name, low, high, value))
+
+class NESControlHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                reply = self.server.dispatch(request)
+                reply['ok'] = True
+            except (PyNESException, ValueError, KeyError, TypeError, OverflowError), e:
+                reply = {'ok': False, 'error': str(e)}
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+class NESControlServer:
+    # Each connection is served on its own thread and each instance runs in
+    # its own process, so slow instances never hold up the others
+    def __init__(self, address, log_level='warning'):
+        self.log_level = log_level
+        self.instances = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.log = get_logger("6502-server", log_level)
+        
+        if address.startswith('unix:'):
+            path = address[5:]
+            if os.path.exists(path):
+                # Only replace a stale socket, never some other file
+                if not stat.S_ISSOCK(os.stat(path).st_mode):
+                    raise PyNESException("%s exists and is not a socket" % path)
+                os.unlink(path)
+            server_class = ThreadingUnixServer
+            bind = path
+        else:
+            (host, sep, port) = address.rpartition(':')
+            server_class = ThreadingTCPServer
+            bind = (host or '127.0.0.1', int(port))
+        self.server = server_class(bind, NESControlHandler)
+        self.server.dispatch = self.dispatch
+    
+    def serve_forever(self):
+        self.log.warning("Serving on %s" % (self.server.server_address,))
+        try:
+            self.server.serve_forever()
+        finally:
+            for worker in self.instances.values():
+                worker.close()
+    
+    def get_instance(self, request):
+        worker = self.instances.get(request['instance'])
+        if worker is None:
+            raise PyNESException("No such instance: %s" % request['instance'])
+        return worker
+    
+    def dispatch(self, request):
+        cmd = request['cmd']
+        if cmd == 'load':
+            worker = EmulatorWorker(str(request['rom']), self.log_level)
+            self.lock.acquire()
+            try:
+                instance = self.next_id
+                self.next_id += 1
+                self.instances[instance] = worker
+            finally:
+                self.lock.release()
+            return {'instance': instance}
+        elif cmd == 'list':
+            return {'instances': [{'instance': i, 'rom': w.rom} \
+                for (i, w) in sorted(self.instances.items())]}
+        elif cmd == 'close':
+            worker = self.get_instance(request)
+            del self.instances[request['instance']]
+            worker.close()
+            return {}
+        
+        worker = self.get_instance(request)
+        if cmd == 'step':
+            frames = int(request.get('frames', 1))
+            check_value('frames', frames, 0, MAX_STEP_FRAMES)
+            return {'frame_count': worker.call('step', frames)}
+        elif cmd == 'input':
+            buttons = request['buttons']
+            if isinstance(buttons, list):
+                buttons = [str(b) for b in buttons]
+            port = int(request.get('port', 1))
+            check_value('port', port, 1, 2)
+            worker.call('input', port, buttons)
+            return {}
+        elif cmd == 'read':
+            (addr, length) = (int(request['addr']), int(request['length']))
+            check_range(addr, length)
+            data = worker.call('read', addr, length)
+            return {'data': base64.b64encode(data)}
+        elif cmd == 'write':
+            (addr, data) = (int(request['addr']), base64.b64decode(request['data']))
+            check_range(addr, len(data))
+            worker.call('write', addr, data)
+            return {}
+        elif cmd == 'frame':
+            fmt = request.get('format', 'indexed')
+            if fmt not in ('indexed', 'rgb'):
+                raise PyNESException("Unknown frame format: %s" % fmt)
+            data = worker.call('frame', fmt)
+            return {'data': base64.b64encode(data), 'width': FRAME_WIDTH, 'height': FRAME_HEIGHT}
+        elif cmd == 'save_state':
+            return {'state': base64.b64encode(worker.call('save_state'))}
+        elif cmd == 'load_state':
+            worker.call('load_state', base64.b64decode(request['state']))
+            return {}
+        raise PyNESException("Unknown command: %s" % cmd)
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
@@ -0,0 +1,151 @@
+import collections
+import re
+
+from pynes import *
+from nesdebug import disassemble
+
+# Lines in the nestest.log layout, as written by Nintendulator:
+# C000  4C F5 C5  JMP $C5F5          A:00 X:00 Y:00 P:24 SP:FD PPU:  0, 21 CYC:7
+TRACE_RE = re.compile(r'^([0-9A-Fa-f]{4})\s+((?:[0-9A-Fa-f]{2} ){0,2}[0-9A-Fa-f]{2})\b')
+REGS_RE = re.compile(r'A:([0-9A-Fa-f]{2}) X:([0-9A-Fa-f]{2}) Y:([0-9A-Fa-f]{2}) '
+                     r'P:([0-9A-Fa-f]{2}) SP:([0-9A-Fa-f]{2})')
+CYC_RE = re.compile(r'CYC:\s*(\d+)')
+
+FIELDS = ['PC', 'bytes', 'A', 'X', 'Y', 'P', 'SP', 'CYC']
+
+# Record: (pc, opcode bytes, a, x, y, p, sp, cycles). cycles is None when
+# the log doesn't have a CPU cycle count.
+def parse_trace_line(line):
+    m = TRACE_RE.match(line)
+    regs = REGS_RE.search(line)
+    if m is None or regs is None:
+        return None
+    raw = ''.join([chr(int(b, 16)) for b in m.group(2).split()])
+    (a, x, y, p, sp) = [int(v, 16) for v in regs.groups()]
+    cycles = None
+    # Older logs have "CYC:nnn SL:nn", where CYC is the PPU dot, not CPU cycles
+    cyc = CYC_RE.search(line)
+    if cyc and 'SL:' not in line:
+        cycles = int(cyc.group(1))
+    return (int(m.group(1), 16), raw, a, x, y, p, sp, cycles)
+
+# Streams records from a log, one line at a time. Lines that aren't blank
+# but don't parse are passed on with a None record.
+def read_trace(filename):
+    for (line_no, line) in enumerate(open(filename), 1):
+        record = parse_trace_line(line)
+        if record is not None or line.strip():
+            yield (line_no, record)
+
+def format_record(record, text=''):
+    (pc, raw, a, x, y, p, sp, cycles) = record
+    line = "%04X  %-8s  %-30s  A:%02X X:%02X Y:%02X P:%02X SP:%02X" % \
+        (pc, ' '.join(["%02X" % ord(c) for c in raw]), text, a, x, y, p, sp)
+    if cycles is not None:
+        line += " CYC:%d" % cycles
+    return line
+
+class NESTraceChecker:
+    # Single steps a core and compares its state before every instruction
+    # with the next record of a reference log. Neither side is kept in
+    # memory beyond the last few lines shown as context.
+    def __init__(self, nes_core, reference=None, output=None, context=8):
+        self.nes_core = nes_core
+        self.reference = reference
+        self.output = output
+        self.context = collections.deque(maxlen=context)
+        self.count = 0
+        self.skipped = []
+    
+    def capture(self):
+        core = self.nes_core
+        (raw, text, length) = disassemble(core, core.PC)
+        record = (core.PC, core.peek_memory(core.PC, length), core.A, core.X, core.Y,
+                  core.get_all_flags(), core.S & 0xFF, core.total_cycles())
+        return (record, text)
+    
+    # Start the core from the state of the first reference record, like
+    # nestest's automated mode which begins at $C000
+    def sync(self, record):
+        core = self.nes_core
+        (pc, raw, a, x, y, p, sp, cycles) = record
+        (core.PC, core.A, core.X, core.Y, core.S) = (pc, a, x, y, sp)
+        core.set_all_flags(p)
+        if cycles is not None:
+            core.elapsed_cycles = cycles - core.cycle_count
+    
+    def step(self):
+        try:
+            self.nes_core.step()
+        except PyNESException:
+            return False
+        return True
+    
+    def compare(self, expected, actual):
+        diffs = []
+        for (name, e, a) in zip(FIELDS, expected, actual):
+            if name == 'CYC' and e is None:
+                continue
+            if e != a:
+                diffs.append(name)
+        return diffs
+    
+    def report(self, line_no, expected, actual, text, reason):
+        print "Divergence at instruction %d (reference line %d): %s" % \
+            (self.count + 1, line_no, reason)
+        for (ref_line, line) in self.context:
+            print "   %s" % line
+        print "-> expected: %s" % format_record(expected)
+        print "-> actual:   %s" % format_record(actual, text)
+    
+    def warn_skipped(self):
+        if self.skipped:
+            print "Warning: %d reference lines could not be parsed (first at line %d)" % \
+                (len(self.skipped), self.skipped[0])
+    
+    # Returns True if the core matched every reference record
+    def check(self, sync=True, limit=None):
+        compared = 0
+        for (line_no, expected) in read_trace(self.reference):
+            if expected is None:
+                self.skipped.append(line_no)
+                continue
+            compared += 1
+            if sync and compared == 1:
+                self.sync(expected)
+            (actual, text) = self.capture()
+            if expected[7] is None:
+                actual = actual[:7] + (None,)
+            act_line = format_record(actual, text)
+            if self.output:
+                self.output.write(act_line + '\n')
+        
+            diffs = self.compare(expected, actual)
+            if diffs:
+                self.warn_skipped()
+                self.report(line_no, expected, actual, text, "%s differ" % ', '.join(diffs))
+                return False
+            self.context.append((line_no, act_line))
+            if limit and self.count >= limit:
+                break
+            if not self.step():
+                self.warn_skipped()
+                self.report(line_no, expected, actual, text,
+                    "opcode $%02x not implemented" % ord(actual[1][0]))
+                return False
+            self.count += 1
+        self.warn_skipped()
+        if compared == 0:
+            print "Error: no instructions found in reference %s" % self.reference
+            return False
+        print "%d instructions match the reference" % self.count
+        return True
+    
+    # Writes the core's own trace, e.g. to check a later change against it
+    def record(self, limit=None):
+        while limit is None or self.count < limit:
+            (actual, text) = self.capture()
+            self.output.write(format_record(actual, text) + '\n')
+            if not self.step():
+                break
+            self.count += 1
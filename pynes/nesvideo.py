@@ -0,0 +1,198 @@
+import Queue
+import struct
+import sys
+import threading
+
+from pynes import *
+
+FRAME_WIDTH = 256
+FRAME_HEIGHT = 240
+FRAME_SIZE = FRAME_WIDTH * FRAME_HEIGHT
+
+# Backdrop colour used to clear a frame (palette entry $0F is black)
+BLANK_COLOR = 0x0F
+
+# 3-byte RGB strings for every possible pixel value, for indexed -> RGB conversion
+def rgb_table(palette):
+    return [struct.pack("BBB", *palette[i & 0x3F]) for i in range(256)]
+
+def frame_to_rgb(frame, table):
+    return ''.join([table[ord(c)] for c in str(frame)])
+
+class FrameQueue:
+    # Two preallocated framebuffers of NES palette indices (one byte per pixel).
+    # The core always owns 'back' and renders into it. submit() hands 'back'
+    # over to the presenter by reference and gives the core the other buffer.
+    # If the presenter still holds the previous frame, the new frame is
+    # dropped and the core simply keeps drawing into the same buffer.
+    def __init__(self):
+        self.buffers = [bytearray(FRAME_SIZE), bytearray(FRAME_SIZE)]
+        self.back = self.buffers[0]
+        self.front = None
+        self.closed = False
+        self.submitted = 0
+        self.dropped = 0
+        self.cond = threading.Condition()
+    
+    def submit(self):
+        self.cond.acquire()
+        try:
+            if self.front is not None:
+                self.dropped += 1
+                return False
+            self.front = self.back
+            if self.back is self.buffers[0]:
+                self.back = self.buffers[1]
+            else:
+                self.back = self.buffers[0]
+            self.submitted += 1
+            self.cond.notify()
+            return True
+        finally:
+            self.cond.release()
+    
+    # Presenter side: block until a frame is available, None once closed
+    def acquire(self):
+        self.cond.acquire()
+        try:
+            while self.front is None and not self.closed:
+                self.cond.wait(0.5)
+            if self.closed:
+                return None
+            return self.front
+        finally:
+            self.cond.release()
+    
+    def release(self):
+        self.cond.acquire()
+        try:
+            self.front = None
+        finally:
+            self.cond.release()
+    
+    def close(self):
+        self.cond.acquire()
+        try:
+            self.closed = True
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+class PygameDisplay:
+    def __init__(self, palette):
+        self.palette = palette
+        self.window = None
+    
+    def open(self):
+        # pygame is only imported once a window is actually wanted, which keeps
+        # it out of headless startup entirely
+        import pygame
+        self.pygame = pygame
+        pygame.init()
+        self.window = pygame.display.set_mode((FRAME_WIDTH, FRAME_HEIGHT))
+    
+    def present(self, frame):
+        pygame = self.pygame
+        surface = pygame.image.fromstring(str(frame), (FRAME_WIDTH, FRAME_HEIGHT), 'P')
+        surface.set_palette(self.palette)
+        self.window.blit(surface, (0,0))
+        pygame.display.update()
+    
+    def close(self):
+        self.pygame.display.quit()
+
+class FramePresenter(threading.Thread):
+    def __init__(self, frames, display):
+        threading.Thread.__init__(self, name="pynes-presenter")
+        self.daemon = True
+        self.frames = frames
+        self.display = display
+    
+    def run(self):
+        # The display is opened here so that all video calls come from this thread
+        self.display.open()
+        while True:
+            frame = self.frames.acquire()
+            if frame is None:
+                break
+            try:
+                self.display.present(frame)
+            finally:
+                self.frames.release()
+        self.display.close()
+    
+    def stop(self):
+        self.frames.close()
+        self.join()
+
+class FrameDumper(threading.Thread):
+    # Streams every finished frame as a PPM (P6, 'rgb') or PGM (P5, 'indexed'
+    # palette numbers) image, back to back. Such a stream is read directly by
+    # ffmpeg ("-f image2pipe -c:v ppm") and most image libraries.
+    # Frames are copied onto a bounded queue and converted/written by this
+    # thread; the core only blocks if the writer is a full queue behind.
+    def __init__(self, path, palette, format='rgb', queue_size=64):
+        threading.Thread.__init__(self, name="pynes-frame-dumper")
+        self.daemon = True
+        if format == 'rgb':
+            self.header = "P6\n%d %d\n255\n" % (FRAME_WIDTH, FRAME_HEIGHT)
+            self.pixels = rgb_table(palette)
+        elif format == 'indexed':
+            self.header = "P5\n%d %d\n255\n" % (FRAME_WIDTH, FRAME_HEIGHT)
+            self.pixels = None
+        else:
+            raise PyNESException("Unknown frame dump format: %s" % format)
+        if path == '-':
+            # The real stdout: callers move console output to stderr so it
+            # doesn't end up between the frames
+            self.out = sys.__stdout__
+        else:
+            # Works for regular files as well as named pipes
+            self.out = open(path, 'wb', 1 << 20)
+        self.queue = Queue.Queue(queue_size)
+        self.frame_count = 0
+        self.error = None
+        self.start()
+    
+    def write_frame(self, frame):
+        if self.error:
+            raise PyNESException("Frame dump stopped: %s" % self.error)
+        self.queue.put(str(frame))
+    
+    def run(self):
+        pixels = self.pixels
+        data = ''
+        try:
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    break
+                if pixels:
+                    data = frame_to_rgb(data, pixels)
+                self.out.write(self.header)
+                self.out.write(data)
+                self.frame_count += 1
+            self.out.flush()
+        except IOError, e:
+            # The reader went away (EPIPE). Unless the closing None was
+            # already taken (the final flush failed), keep taking frames off
+            # the queue so neither write_frame nor close can block on it.
+            self.error = e
+            while data is not None:
+                data = self.queue.get()
+    
+    # A reader that stops reading without closing the pipe can stall the
+    # writer, so close() gives up waiting for it after 'timeout' seconds
+    def close(self, timeout=10.0):
+        try:
+            self.queue.put(None, True, timeout)
+        except Queue.Full:
+            pass
+        self.join(timeout)
+        if self.is_alive():
+            return
+        if self.out is not sys.__stdout__:
+            try:
+                self.out.close()
+            except IOError:
+                pass